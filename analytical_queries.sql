@@ -1,41 +1,46 @@
+-- The queries read agg_fire_department_injuries_daily, the day x battalion x district rollup the job maintains
+-- from the fact rows it inserts. Averages are rebuilt from the stored sums and counts.
+
 -- 1. Count of Incidents by Day of Week:
-SELECT dd.day_name, COUNT(*) AS incident_count
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
-GROUP BY dd.day_name
+SELECT dd.day_name, SUM(agg.incident_count) AS incident_count
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
+GROUP BY dd.day_name, dd.day_of_week
 ORDER BY dd.day_of_week;
 
 -- 2. Average Number of Alarms by Month:
-SELECT dd.month_name, AVG(fact.num_alarms) AS avg_alarms
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
+SELECT dd.month_name, SUM(agg.num_alarms_sum)::numeric / NULLIF(SUM(agg.num_alarms_count), 0) AS avg_alarms
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
 GROUP BY dd.month_name, dd.month_actual
 ORDER BY dd.month_actual;
 
 -- 3. Total Estimated Property Loss by Quarter:
-SELECT dd.quarter_name, SUM(fact.estimated_property_loss) AS total_property_loss
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
+SELECT dd.quarter_name, SUM(agg.estimated_property_loss_sum) AS total_property_loss
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
 GROUP BY dd.quarter_name, dd.quarter_actual
 ORDER BY dd.quarter_actual;
 
 -- 4. Incident Count and Average Personnel Response by Year:
-SELECT dd.year_actual, COUNT(*) AS incident_count, AVG(fact.suppression_personnel + fact.ems_personnel + fact.other_personnel) AS avg_personnel_response
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
+SELECT dd.year_actual, SUM(agg.incident_count) AS incident_count,
+       SUM(agg.personnel_response_sum)::numeric / NULLIF(SUM(agg.personnel_response_count), 0) AS avg_personnel_response
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
 GROUP BY dd.year_actual
 ORDER BY dd.year_actual;
 
 -- 5. Percentage of Incidents with Fatalities by Weekend/Weekday:
-SELECT dd.weekend_indr, (SUM(fact.fire_fatalities) + SUM(fact.civilian_fatalities)) / COUNT(*) * 100 AS percentage_fatalities
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
+SELECT dd.weekend_indr,
+       (SUM(agg.fire_fatalities_sum) + SUM(agg.civilian_fatalities_sum)) / SUM(agg.incident_count) * 100 AS percentage_fatalities
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
 GROUP BY dd.weekend_indr;
 
 -- 6. Top 5 Days with the Highest Average Number of Alarms:
-SELECT dd.date_actual, AVG(fact.num_alarms) AS avg_alarms
-FROM your_table_name fact
-JOIN dim_date dd ON fact.incident_date = dd.date_actual
+SELECT dd.date_actual, SUM(agg.num_alarms_sum)::numeric / NULLIF(SUM(agg.num_alarms_count), 0) AS avg_alarms
+FROM agg_fire_department_injuries_daily agg
+JOIN dim_date dd ON agg.date_dim_id = dd.date_dim_id
 GROUP BY dd.date_actual
-ORDER BY avg_alarms DESC
+ORDER BY avg_alarms DESC NULLS LAST
 LIMIT 5;
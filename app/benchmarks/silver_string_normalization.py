@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+import timeit
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fire_department.utils import Utils  # noqa: E402
+
+# Micro benchmark of the silver string normalization, per cell Utils.clean_str / Utils.first_letter_acronym against
+# their vectorized versions. The outputs are compared before timing, any difference aborts the run
+
+BATTALIONS = ['B01', 'b02 ', ' B03', 'B04', 'B05', 'b06', 'B07', 'B08', 'B09', 'B10', None]
+DISTRICTS = ['Bernal Heights', 'financial district/south beach ', 'Mission', ' Outer Richmond', 'Noe Valley',
+             'South of Market', 'Twin Peaks', 'West of Twin Peaks', 'Lone Mountain/USF', None]
+CITIES = ['San Francisco', 'SF', 'SAN FRANCISCO', 'Presidio', 'Treasure Isla', 'Yerba Buena', 'FM', 'San  Fran  ', None]
+
+
+def build_dataframe(rows, seed):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'battalion': rng.choice(np.array(BATTALIONS, dtype=object), rows),
+        'neighborhood_district': rng.choice(np.array(DISTRICTS, dtype=object), rows),
+        'city': rng.choice(np.array(CITIES, dtype=object), rows),
+    })
+
+
+def per_cell(dataframe):
+    cleaned = dataframe.map(Utils.clean_str)
+    return cleaned.assign(city_cleaned=cleaned['city'].apply(Utils.first_letter_acronym))
+
+
+def vectorized(dataframe):
+    cleaned = Utils.clean_str_columns(dataframe)
+    return cleaned.assign(city_cleaned=Utils.first_letter_acronym_series(cleaned['city']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Silver string normalization benchmark')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    dataframe = build_dataframe(arguments.rows, arguments.seed)
+
+    pd.testing.assert_frame_equal(per_cell(dataframe), vectorized(dataframe))
+    print(f'Outputs are identical on {arguments.rows} rows')
+
+    per_cell_seconds = min(timeit.repeat(lambda: per_cell(dataframe), number=1, repeat=arguments.repeat))
+    vectorized_seconds = min(timeit.repeat(lambda: vectorized(dataframe), number=1, repeat=arguments.repeat))
+    print(f'per cell:   {per_cell_seconds:.3f}s')
+    print(f'vectorized: {vectorized_seconds:.3f}s')
+    print(f'speedup:    {per_cell_seconds / vectorized_seconds:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,20 @@
+import argparse
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from fire_department.metrics import pipeline_metrics
+from fire_department.object_cache import S3ObjectCache
+from fire_department.pipeline import StagePipeline
+from fire_department.quality import DataQualityRules
 from fire_department.setup.app_settings import AppSettings
 from fire_department.setup.field_settings import FieldSettings
-from fire_department.repository.postgres.gold import dim_batallion_sql_query, dim_district_sql_query, \
-    fact_fire_department_injuries_sql_query
+from fire_department.repository.postgres.analytical import explain_checks
+from fire_department.repository.postgres.gold import dimension_keys, dimension_merges, fact_index_sql_queries, \
+    fact_merges, truncate_staging_sql_query
 from fire_department.utils import Utils
 from fire_department.repository.model.bronze import RawFireDepartmentModel, RawBattalionModel, RawDistrictModel
+from fire_department.repository.model.quarantine import QuarantineModel
 from fire_department.repository.model.silver import StgFireDepartmentModel, StgBattalionModel, StgDistrictModel
 from sqlalchemy import create_engine
 
@@ -17,12 +25,26 @@ logging.basicConfig(level=logging.INFO)
 def validate_dataframes(dataframes_and_models):
     validated_dataframes = []
     for dataframe, model in dataframes_and_models:
-        validated_dataframes.append(Utils.validate_dataframe(dataframe, model))
+        with pipeline_metrics.stage('validate', model=model.__name__) as record:
+            validated_dataframes.append(Utils.validate_dataframe(dataframe, model))
+            record['rows'] = len(dataframe)
     return validated_dataframes
 
-def execute_bulk_db_load(dataframes_and_table_names, engine):
-    for dataframe, table_name in dataframes_and_table_names:
-        Utils.df_execute_bulk_db_load(dataframe, table_name, engine)
+def execute_bulk_db_load(dataframes_and_table_names, engine, load_workers):
+    # Tables of the same layer do not depend on each other, each one is loaded on its own pooled connection
+    def load_table(dataframe, table_name):
+        postgres_connection = engine.raw_connection()
+        try:
+            return Utils.df_execute_bulk_db_load(dataframe, table_name, postgres_connection)
+        finally:
+            # Hands the connection back to the pool
+            postgres_connection.close()
+
+    with ThreadPoolExecutor(max_workers=load_workers) as executor:
+        futures = [executor.submit(load_table, dataframe, table_name)
+                   for dataframe, table_name in dataframes_and_table_names]
+        # Barrier, the layer is complete only when every table has been loaded
+        return [future.result() for future in futures]
 
 
 def get_app_settings():
@@ -33,9 +55,415 @@ def get_field_settings():
     return FieldSettings()
 
 
-def main():
+def get_quality_rules(raw_model, fields, app_settings):
+    if not app_settings.data_quality_checks:
+        return None
+    return DataQualityRules(raw_model, fields.raw_fact_quality_constraints)
+
+
+def load_quarantined_rows(quarantined_rows, batch_id, stage, object_key, object_etag, app_settings, engine,
+                          load_workers):
+    quarantine_dataframe = DataQualityRules.create_quarantine_dataframe(quarantined_rows, batch_id, stage, object_key,
+                                                                        object_etag)
+    quarantine_validated_dataframes = validate_dataframes([(quarantine_dataframe, QuarantineModel)])
+    execute_bulk_db_load(zip(quarantine_validated_dataframes, [app_settings.quarantine_table_name]), engine,
+                         load_workers)
+    logging.warning(f'{len(quarantine_dataframe)} rows of {object_key} quarantined in '
+                    f'{app_settings.quarantine_table_name}')
+
+
+def get_object_cache(arguments, app_settings):
+    if arguments.no_object_cache or not app_settings.s3_cache_dir:
+        return None
+    return S3ObjectCache(app_settings.s3_cache_dir, app_settings.s3_cache_max_bytes)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description='Fire Department DW job')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='Stream the S3 object through the bronze and silver stages in chunks of this many rows')
+    parser.add_argument('--load-workers', type=int, default=None,
+                        help='Number of tables of a layer loaded concurrently')
+    parser.add_argument('--explain-check', action='store_true',
+                        help='Check the plans of the reference fact queries with EXPLAIN instead of loading data')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='Log the memory held by the dataframes of every stage')
+    parser.add_argument('--skip-bronze', action='store_true',
+                        help='Read only the columns the silver and gold stages need and do not load the bronze tables')
+    parser.add_argument('--bronze-only', action='store_true',
+                        help='Only load the raw bronze tables, for deployments that schedule the raw copy on its own')
+    parser.add_argument('--metrics-report', default=None,
+                        help='Write the wall time, CPU time, rows, bytes and peak RSS of every stage to this JSON file')
+    parser.add_argument('--metrics-table', action='store_true',
+                        help='Also write the stage metrics of the run to the pipeline_run_metrics table')
+    parser.add_argument('--no-object-cache', action='store_true',
+                        help='Read every object from S3 instead of the local object cache')
+    parser.add_argument('--no-pipeline', action='store_true',
+                        help='Run the read, transform and load stages one after the other instead of overlapping them')
+    return parser.parse_args(args)
+
+
+def run_explain_check(postgres_connection):
+    regressions = {}
+    for check_name, query, expected_nodes, max_fact_partitions in explain_checks:
+        plan = Utils.get_query_plan(postgres_connection, query)
+        problems = Utils.check_query_plan(plan, expected_nodes, max_fact_partitions)
+        if problems:
+            regressions[check_name] = problems
+            logging.error(f"Plan regression in {check_name}: {problems}")
+        else:
+            logging.info(f"Plan of {check_name} is the expected one")
+
+    if regressions:
+        raise ValueError(f"Plan regressions found in {sorted(regressions)}")
+
+
+def get_raw_model(fields, load_bronze):
+    # Bronze keeps every raw column, silver and gold only need the staged fact and the dimension columns
+    if load_bronze:
+        return RawFireDepartmentModel
+    return Utils.get_projected_model(RawFireDepartmentModel,
+                                     fields.stg_fact_fire_fighters_injured_fields + fields.raw_dim_district_fields
+                                     + fields.raw_dim_battalion_fields,
+                                     'ProjectedRawFireDepartmentModel')
+
+
+def get_pending_objects(s3_client, bucket_name, postgres_connection, app_settings, stage='warehouse'):
+    with pipeline_metrics.stage('list_pending_objects', ingestion_stage=stage) as record:
+        pending_objects = find_pending_objects(s3_client, bucket_name, postgres_connection, app_settings, stage)
+        record['rows'] = len(pending_objects)
+    return pending_objects
+
+
+def find_pending_objects(s3_client, bucket_name, postgres_connection, app_settings, stage):
+    manifest = Utils.read_manifest_from_s3(s3_client, bucket_name, app_settings.manifest_file_name)
+    if manifest is None:
+        # No manifest, the file with the maximum last modified timestamp holds the whole history
+        latest_file_name = Utils.get_latest_file_name(Utils.list_files_in_s3(s3_client, bucket_name))
+        if latest_file_name is None:
+            return []
+        entries = [{'key': latest_file_name,
+                    'etag': Utils.get_s3_object_etag(s3_client, bucket_name, latest_file_name)}]
+    else:
+        entries = manifest['objects']
+
+    if not app_settings.incremental_ingestion:
+        return [(entry['key'], entry['etag']) for entry in entries]
+
+    # Skip objects that were already ingested with the same content
+    pending_objects = []
+    for entry in entries:
+        if Utils.is_manifest_entry_ingested(postgres_connection, entry, stage):
+            logging.info(f"{entry['key']} ({entry['etag']}) was already ingested ({stage})")
+        else:
+            pending_objects.append((entry['key'], entry['etag']))
+    return pending_objects
+
+
+def load_dimension_key_cache(postgres_connection, unknown_sk):
+    # Natural key to surrogate key maps by dimension table, the unknown member is created first so it is part of them
+    dimension_key_cache = {}
+    for table_name, _, _, keys_query, unknown_member_query in dimension_keys:
+        Utils.ensure_unknown_dimension_member(postgres_connection, unknown_member_query, unknown_sk)
+        dimension_key_cache[table_name] = Utils.get_dimension_surrogate_keys(postgres_connection, keys_query)
+    return dimension_key_cache
+
+
+def resolve_dimension_keys(stg_fact_fire_department, stg_dim_dataframes, postgres_connection, dimension_key_cache,
+                           batch_id, app_settings):
+    unknown_sk = app_settings.unknown_dimension_sk
+    # Dimensions are merged into gold and their maps reloaded only when the chunk staged members not seen before in
+    # the run, or brings keys not cached yet. Only new and changed members are written
+    if any(not dataframe.empty for dataframe in stg_dim_dataframes) or \
+            any(Utils.has_unresolved_keys(stg_fact_fire_department[natural_key], dimension_key_cache[table_name])
+                for table_name, natural_key, _, _, _ in dimension_keys):
+        Utils.execute_gold_merges(postgres_connection, dimension_merges[app_settings.dimension_scd_type], batch_id)
+        for table_name, _, _, keys_query, _ in dimension_keys:
+            dimension_key_cache[table_name] = Utils.get_dimension_surrogate_keys(postgres_connection, keys_query)
+
+    with pipeline_metrics.stage('map_surrogate_keys') as record:
+        record['rows'] = len(stg_fact_fire_department)
+        return stg_fact_fire_department.assign(**{
+            surrogate_key: Utils.map_surrogate_keys(stg_fact_fire_department[natural_key],
+                                                    dimension_key_cache[table_name], unknown_sk)
+            for table_name, natural_key, surrogate_key, _, _ in dimension_keys
+        })
+
+
+def iter_new_chunks(s3_client, bucket_name, object_key, object_etag, object_cache, raw_model, quality_rules,
+                    watermark_id, arguments, app_settings, fields):
+    if app_settings.incremental_ingestion:
+        # Objects whose id high-water mark, read from their metadata, is not above the watermark hold no new rows and
+        # are not downloaded. Objects without it are read and filtered
+        object_max_id = Utils.get_object_stats_max(Utils.get_s3_object_stats(s3_client, bucket_name, object_key), 'id')
+        if object_max_id is not None and object_max_id <= watermark_id:
+            logging.info(f'{object_key} has no rows above id watermark {watermark_id}, it is not read')
+            return
+
+    # Parquet row groups entirely below the watermark are not downloaded
+    read_watermark = ('id', watermark_id) if app_settings.incremental_ingestion else None
+    # Low cardinality text columns are read as categoricals
+    categorical_fields = fields.raw_categorical_fields if app_settings.categorical_encoding else None
+
+    # Retrieve the file from s3 in pandas data frames, either whole or streamed in chunks
+    if arguments.chunk_size:
+        raw_fact_fire_department_chunks = Utils.get_file_from_s3_as_dataframe_chunks(
+            s3_client, bucket_name, object_key, raw_model, arguments.chunk_size, read_watermark,
+            categorical_fields, app_settings.categorical_max_unique_ratio, app_settings.s3_download_part_size,
+            app_settings.s3_download_concurrency, object_etag, object_cache)
+    else:
+        raw_fact_fire_department_chunks = [
+            Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name, object_key, raw_model,
+                                                read_watermark, categorical_fields,
+                                                app_settings.categorical_max_unique_ratio,
+                                                app_settings.s3_download_part_size,
+                                                app_settings.s3_download_concurrency, object_etag, object_cache)
+        ]
+
+    # Yields the valid rows and the rows failing a data quality rule, with their reason codes
+    for raw_fact_fire_department, coercion_failures, source_rows in raw_fact_fire_department_chunks:
+        if quality_rules is not None:
+            with pipeline_metrics.stage('data_quality', object_key=object_key) as record:
+                raw_fact_fire_department, quarantined_rows = quality_rules.split(raw_fact_fire_department,
+                                                                                 coercion_failures, source_rows)
+                record['rows'] = len(raw_fact_fire_department) + len(quarantined_rows)
+        else:
+            quarantined_rows = raw_fact_fire_department.iloc[:0].assign(reason_codes=None, record=None)
+        # The rows as read are only needed to record the quarantined ones
+        del source_rows
+
+        # Keep only the rows above the ingestion watermark, quarantined rows without an id are kept as well
+        if app_settings.incremental_ingestion:
+            raw_fact_fire_department = Utils.filter_rows_above_watermark(raw_fact_fire_department, 'id',
+                                                                         watermark_id)
+            quarantined_rows = quarantined_rows[quarantined_rows['id'].isna()
+                                                | (quarantined_rows['id'] > watermark_id).fillna(False)]
+            logging.info(f'{len(raw_fact_fire_department)} new rows above id watermark {watermark_id}')
+        if not (raw_fact_fire_department.empty and quarantined_rows.empty):
+            yield raw_fact_fire_department, quarantined_rows
+
+
+def iter_pending_chunks(s3_client, bucket_name, pending_objects, object_cache, raw_model, quality_rules, watermark_id,
+                        arguments, app_settings, fields):
+    # Chunks of every pending object as (object_key, object_etag, valid rows, quarantined rows), each object is closed
+    # by an item without rows so the consumer knows when it is complete
+    for object_key, object_etag in pending_objects:
+        logging.info(f'Current file name: {object_key}')
+        for raw_fact_fire_department, quarantined_rows in iter_new_chunks(
+                s3_client, bucket_name, object_key, object_etag, object_cache, raw_model, quality_rules,
+                watermark_id, arguments, app_settings, fields):
+            # Objects are written with increasing keys, the next one only needs rows above this one. The watermark
+            # only follows loaded rows, a quarantined row with an outlying id cannot hide later rows
+            watermark_id = max(watermark_id, Utils.get_column_max(raw_fact_fire_department, 'id'))
+            yield object_key, object_etag, raw_fact_fire_department, quarantined_rows
+        yield object_key, object_etag, None, None
+
+
+def run_stages(source, stages, arguments, app_settings):
+    # The stages run on their own threads joined by bounded queues, so reading the next chunk from S3, transforming
+    # the previous one and loading the one before overlap. The calling thread consumes the items and does the
+    # database work on its connection. Sequentially, every item goes through all the stages before the next is read
+    if arguments.no_pipeline or not app_settings.pipelined_execution:
+        for item in source:
+            for _, function in stages:
+                item = function(item)
+            yield item
+    else:
+        yield from StagePipeline(source, stages, app_settings.pipeline_queue_size)
+
+
+def create_raw_dimension_dataframes(raw_fact_fire_department, fields, app_settings, seen_dimension_keys):
+    # Raw dimensions creation, members already emitted by a previous chunk are not loaded again
+    with pipeline_metrics.stage('dimension_dedup') as record:
+        record['rows'] = len(raw_fact_fire_department)
+        raw_dim_district_dataframe = Utils.drop_seen_rows(
+            Utils.create_dataframe_without_duplicates(fields.raw_dim_district_fields, raw_fact_fire_department),
+            fields.raw_dim_district_fields, seen_dimension_keys[app_settings.raw_dim_district_table_name])
+        raw_dim_battalion_dataframe = Utils.drop_seen_rows(
+            Utils.create_dataframe_without_duplicates(fields.raw_dim_battalion_fields, raw_fact_fire_department),
+            fields.raw_dim_battalion_fields, seen_dimension_keys[app_settings.raw_dim_battalion_table_name])
+    return raw_dim_battalion_dataframe, raw_dim_district_dataframe
+
+
+def load_bronze_chunk(raw_fact_fire_department, raw_dim_battalion_dataframe, raw_dim_district_dataframe,
+                      object_key, object_etag, app_settings, engine, load_workers):
+    # Validating raw/bronze data
+    # List of dataframes and corresponding models, every row is tagged with the object it was read from
+    raw_dataframes_and_models = [
+        (dataframe.assign(object_key=object_key, object_etag=object_etag), model)
+        for dataframe, model in [
+            (raw_dim_battalion_dataframe, RawBattalionModel),
+            (raw_dim_district_dataframe, RawDistrictModel),
+            (raw_fact_fire_department, RawFireDepartmentModel),
+        ]
+    ]
+    # Validating raw/bronze data
+    raw_validated_dataframes = validate_dataframes(raw_dataframes_and_models)
+
+    # Writing raw/bronze data
+    execute_bulk_db_load(zip(raw_validated_dataframes, [
+        app_settings.raw_dim_battalion_table_name,
+        app_settings.raw_dim_district_table_name,
+        app_settings.raw_fact_fire_department_table_name,
+    ]), engine, load_workers)
+
+
+def transform_chunk(raw_fact_fire_department, fields, app_settings, seen_dimension_keys, batch_id,
+                    memory_report=False):
+    # Dataframe work only, it can run ahead of the loads of the previous chunk
+    # Bronze STAGE
+    raw_dim_battalion_dataframe, raw_dim_district_dataframe = create_raw_dimension_dataframes(
+        raw_fact_fire_department, fields, app_settings, seen_dimension_keys)
+    if memory_report:
+        Utils.log_memory_report('bronze', {
+            app_settings.raw_dim_battalion_table_name: raw_dim_battalion_dataframe,
+            app_settings.raw_dim_district_table_name: raw_dim_district_dataframe,
+            app_settings.raw_fact_fire_department_table_name: raw_fact_fire_department,
+        })
+
+    # Silver Stage
+    # Stage/silver creation, every staged row is tagged with the batch it belongs to
+    with pipeline_metrics.stage('silver_transform') as record:
+        record['rows'] = len(raw_fact_fire_department)
+        stg_dim_battalion_dataframe = (
+            Utils.clean_str_columns(raw_dim_battalion_dataframe).assign(batch_id=batch_id)
+            .pipe(Utils.add_row_hash, fields.stg_dim_battalion_hash_fields)
+        )
+        stg_dim_district_dataframe = (
+            Utils.clean_str_columns(raw_dim_district_dataframe).assign(
+                # creating a new normalized field for city
+                city_cleaned=lambda df: Utils.first_letter_acronym_series(df[fields.dim_district_fields.city]),
+                batch_id=batch_id)
+            .pipe(Utils.add_row_hash, fields.stg_dim_district_hash_fields)
+        )
+        stg_fact_fire_department = (raw_fact_fire_department[fields.stg_fact_fire_fighters_injured_fields]
+        # Only measures are defaulted to 0, incident_date keeps its null timestamps
+        .pipe(lambda df: df.fillna({column: 0 for column in df.select_dtypes('number').columns}))
+        .assign(
+            neighborhood_district=Utils.clean_str_series(
+                raw_fact_fire_department[fields.dim_district_fields.neighborhood_district]),
+            battalion=Utils.clean_str_series(raw_fact_fire_department[fields.dim_battalion_fields.battalion]),
+            batch_id=batch_id
+        )
+        )
+
+    return (raw_dim_battalion_dataframe, raw_dim_district_dataframe, stg_dim_battalion_dataframe,
+            stg_dim_district_dataframe, stg_fact_fire_department)
+
+
+def load_chunk(raw_fact_fire_department, transformed_dataframes, object_key, object_etag, app_settings, engine,
+               load_workers, batch_id, postgres_connection, dimension_key_cache, memory_report=False,
+               load_bronze=True):
+    (raw_dim_battalion_dataframe, raw_dim_district_dataframe, stg_dim_battalion_dataframe,
+     stg_dim_district_dataframe, stg_fact_fire_department) = transformed_dataframes
+
+    # The raw copy is skipped when only the projected columns were read
+    if load_bronze:
+        load_bronze_chunk(raw_fact_fire_department, raw_dim_battalion_dataframe, raw_dim_district_dataframe,
+                          object_key, object_etag, app_settings, engine, load_workers)
+
+    # List of dataframes and corresponding models
+    stg_dim_dataframes_and_models = [
+        (stg_dim_battalion_dataframe, StgBattalionModel),
+        (stg_dim_district_dataframe, StgDistrictModel),
+    ]
+    # Validating stg/silver dimensions
+    stg_validated_dim_dataframes = validate_dataframes(stg_dim_dataframes_and_models)
+
+    # Writing stg/silver dimensions, the fact needs their surrogate keys
+    execute_bulk_db_load(zip(stg_validated_dim_dataframes, [
+        app_settings.stg_dim_battalion_table_name,
+        app_settings.stg_dim_district_table_name,
+    ]), engine, load_workers)
+
+    # Attaching the surrogate keys to the fact before it is staged
+    stg_fact_fire_department = resolve_dimension_keys(stg_fact_fire_department, stg_validated_dim_dataframes,
+                                                      postgres_connection, dimension_key_cache, batch_id,
+                                                      app_settings)
+    if memory_report:
+        Utils.log_memory_report('silver', {
+            app_settings.stg_dim_battalion_table_name: stg_dim_battalion_dataframe,
+            app_settings.stg_dim_district_table_name: stg_dim_district_dataframe,
+            app_settings.stg_fact_fire_department_table_name: stg_fact_fire_department,
+        })
+
+    # Validating and writing stg/silver fact
+    stg_validated_fact_dataframes = validate_dataframes([(stg_fact_fire_department, StgFireDepartmentModel)])
+    execute_bulk_db_load(zip(stg_validated_fact_dataframes, [
+        app_settings.stg_fact_fire_department_table_name,
+    ]), engine, load_workers)
+
+
+def run_bronze_load(s3_client, bucket_name, object_cache, postgres_connection, engine, load_workers, arguments,
+                    app_settings, fields):
+    # Raw copy on its own, with its own ingestion watermark so it can be scheduled apart from the warehouse load
+    pending_objects = get_pending_objects(s3_client, bucket_name, postgres_connection, app_settings, 'bronze')
+    watermark_id, watermark_incident_number = Utils.get_ingestion_watermark(postgres_connection, 'bronze')
+    seen_dimension_keys = {
+        app_settings.raw_dim_battalion_table_name: set(),
+        app_settings.raw_dim_district_table_name: set(),
+    }
+    quality_rules = get_quality_rules(RawFireDepartmentModel, fields, app_settings)
+
+    def transform(item):
+        object_key, object_etag, raw_fact_fire_department, quarantined_rows = item
+        raw_dim_dataframes = None
+        if raw_fact_fire_department is not None and not raw_fact_fire_department.empty:
+            raw_dim_dataframes = create_raw_dimension_dataframes(raw_fact_fire_department, fields, app_settings,
+                                                                 seen_dimension_keys)
+        return object_key, object_etag, raw_fact_fire_department, quarantined_rows, raw_dim_dataframes
+
+    chunks = iter_pending_chunks(s3_client, bucket_name, pending_objects, object_cache, RawFireDepartmentModel,
+                                 quality_rules, watermark_id, arguments, app_settings, fields)
+    rows_loaded = 0
+    current_object = None
+    for object_key, object_etag, raw_fact_fire_department, quarantined_rows, raw_dim_dataframes in run_stages(
+            chunks, [('transform', transform)], arguments, app_settings):
+        if (object_key, object_etag) != current_object:
+            # First item of the object, nothing of it is loaded before what a failed run left is deleted
+            current_object = (object_key, object_etag)
+            Utils.delete_unrecorded_object_rows(postgres_connection, object_key, object_etag, 'bronze', True)
+        if raw_fact_fire_department is None:
+            # Bronze tables are committed by every bulk load, the object is recorded as soon as it is loaded
+            Utils.check_object_bronze_rows(postgres_connection, object_key, object_etag, rows_loaded)
+            Utils.record_ingestion_watermark(postgres_connection, object_key, object_etag, watermark_id,
+                                             watermark_incident_number, rows_loaded, 'bronze')
+            rows_loaded = 0
+            continue
+
+        if not quarantined_rows.empty:
+            # No batch is opened by a bronze-only run
+            load_quarantined_rows(quarantined_rows, None, 'bronze', object_key, object_etag, app_settings, engine,
+                                  load_workers)
+        if raw_dim_dataframes is not None:
+            raw_dim_battalion_dataframe, raw_dim_district_dataframe = raw_dim_dataframes
+            load_bronze_chunk(raw_fact_fire_department, raw_dim_battalion_dataframe, raw_dim_district_dataframe,
+                              object_key, object_etag, app_settings, engine, load_workers)
+        watermark_id = max(watermark_id, Utils.get_column_max(raw_fact_fire_department, 'id'))
+        watermark_incident_number = max(watermark_incident_number,
+                                        Utils.get_column_max(raw_fact_fire_department, 'incident_number'))
+        rows_loaded += len(raw_fact_fire_department)
+
+
+def write_run_metrics(arguments, app_settings, postgres_connection):
+    # Reporting must never hide the outcome of the run, failures are only logged
+    pipeline_metrics.log_summary()
+    metrics_report_path = arguments.metrics_report or app_settings.metrics_report_path
+    try:
+        if metrics_report_path:
+            pipeline_metrics.write_json_report(metrics_report_path)
+        if arguments.metrics_table or app_settings.metrics_to_postgres:
+            Utils.write_pipeline_metrics(postgres_connection, pipeline_metrics.get_table_rows())
+    except Exception as error:
+        logging.error(f"Error writing the run metrics: {error}")
+
+
+def main(args=None):
     logging.info('Fire Department Job Starting')
+    pipeline_metrics.start_run()
+    run_status = 'failed'
 
+    arguments = parse_arguments(args)
     app_settings = get_app_settings()
     fields = get_field_settings()
 
@@ -53,99 +481,138 @@ def main():
 
     # Instantiate the S3 client
     s3_client = boto3.client('s3', region_name=region_name, endpoint_url=local_stack_endpoint)
+    # Local copies of the objects, seeded by the generator and by previous runs
+    object_cache = get_object_cache(arguments, app_settings)
 
     # Connections instantiations
     db_uri = f'postgresql+pg8000://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}'
-    engine = create_engine(db_uri)
+    load_workers = arguments.load_workers or app_settings.load_workers
+    # The pool holds one connection per load worker, connections are reused by every bulk load of the run
+    engine = create_engine(db_uri, pool_size=load_workers)
     postgres_connection = Utils.connect_to_postgres(db_host, db_port, db_user, db_password, db_name)
 
     try:
 
-        # List files in the S3 bucket
-        file_names_info = Utils.list_files_in_s3(s3_client, bucket_name)
-
-        # Get the file with the maximum last modified timestamp
-        latest_file_name = Utils.get_latest_file_name(file_names_info)
-        logging.info(f'Current file name: {latest_file_name}')
-
-        # Retrieve the file from s3 in a pandas data frame
-        raw_fact_fire_department = Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name,
-                                                                       latest_file_name,
-                                                                       RawFireDepartmentModel)
-
-        # Bronze STAGE
-        # Raw dimensions creation
-        raw_dim_district_dataframe = Utils.create_dataframe_without_duplicates(fields.raw_dim_district_fields,
-                                                                               raw_fact_fire_department)
-        raw_dim_battalion_dataframe = Utils.create_dataframe_without_duplicates(fields.raw_dim_battalion_fields,
-                                                                                raw_fact_fire_department)
-        # Validating raw/bronze data
-        # List of dataframes and corresponding models
-        raw_dataframes_and_models = [
-            (raw_dim_battalion_dataframe, RawBattalionModel),
-            (raw_dim_district_dataframe, RawDistrictModel),
-            (raw_fact_fire_department, RawFireDepartmentModel),
-        ]
-        # Validating raw/bronze data
-        raw_validated_dataframes = validate_dataframes(raw_dataframes_and_models)
-
-        for validated_dataframe, table_name in zip(raw_validated_dataframes, [
-            app_settings.raw_dim_battalion_table_name,
-            app_settings.raw_dim_district_table_name,
-            app_settings.raw_fact_fire_department_table_name,
-        ]):
-            # Writing raw/bronze data
-            Utils.df_execute_bulk_db_load(validated_dataframe, table_name, engine)
-
-        # Silver Stage
-        # Stage/silver creation
-        stg_dim_battalion_dataframe = (
-            raw_dim_battalion_dataframe.map(Utils.clean_str)
-        )
-        stg_dim_district_dataframe = (
-            raw_dim_district_dataframe.map(Utils.clean_str).assign(
-                # creating a new normalized field for city
-                city_cleaned=lambda df: df[fields.dim_district_fields.city].apply(Utils.first_letter_acronym))
-        )
-        stg_fact_fire_department = (raw_fact_fire_department[fields.stg_fact_fire_fighters_injured_fields].fillna(0)
-        .assign(
-            neighborhood_district=raw_fact_fire_department[fields.dim_district_fields.neighborhood_district].apply(
-                Utils.clean_str),
-            battalion=raw_fact_fire_department[fields.dim_battalion_fields.battalion].apply(
-                Utils.clean_str)
-        )
-        )
+        # Fact indexes live on the partitioned table, every partition created later inherits them
+        Utils.execute_and_commit_queries(postgres_connection, fact_index_sql_queries)
 
-        # List of dataframes and corresponding models
-        stg_dataframes_and_models = [
-            (stg_dim_battalion_dataframe, StgBattalionModel),
-            (stg_dim_district_dataframe, StgDistrictModel),
-            (stg_fact_fire_department, StgFireDepartmentModel),
-        ]
-        # Validating stg/silver data
-        stg_validated_dataframes = validate_dataframes(stg_dataframes_and_models)
+        if arguments.explain_check:
+            run_explain_check(postgres_connection)
+            run_status = 'succeeded'
+            return
+
+        if arguments.bronze_only:
+            run_bronze_load(s3_client, bucket_name, object_cache, postgres_connection, engine, load_workers,
+                            arguments, app_settings, fields)
+            logging.info('The bronze load has finished successfully!')
+            run_status = 'succeeded'
+            return
+
+        # Objects not ingested yet, in the order they were written
+        pending_objects = get_pending_objects(s3_client, bucket_name, postgres_connection, app_settings)
+        if not pending_objects:
+            logging.info('Every object was already ingested, nothing to load')
+            run_status = 'succeeded'
+            return
 
-        for validated_dataframe, table_name in zip(stg_validated_dataframes, [
-            app_settings.stg_dim_battalion_table_name,
-            app_settings.stg_dim_district_table_name,
-            app_settings.stg_fact_fire_department_table_name,
-        ]):
-            # Writing stg/silver data
-            Utils.df_execute_bulk_db_load(validated_dataframe, table_name, engine)
+        # Without the bronze copy only the columns silver and gold need are read
+        load_bronze = app_settings.bronze_load and not arguments.skip_bronze
+        raw_model = get_raw_model(fields, load_bronze)
+        quality_rules = get_quality_rules(raw_model, fields, app_settings)
+
+        batch_id = Utils.get_next_batch_id(postgres_connection)
+        logging.info(f'Batch id: {batch_id}')
+        pipeline_metrics.attributes['batch_id'] = batch_id
+
+        dimension_key_cache = load_dimension_key_cache(postgres_connection, app_settings.unknown_dimension_sk)
+
+        watermark_id, watermark_incident_number = Utils.get_ingestion_watermark(postgres_connection)
+        max_id, max_incident_number = watermark_id, watermark_incident_number
+        loaded_objects = []
+
+        # Dimension members already loaded by a previous chunk, by raw table name
+        seen_dimension_keys = {
+            app_settings.raw_dim_battalion_table_name: set(),
+            app_settings.raw_dim_district_table_name: set(),
+        }
+
+        def transform(item):
+            object_key, object_etag, raw_fact_fire_department, quarantined_rows = item
+            transformed_dataframes = None
+            if raw_fact_fire_department is not None and not raw_fact_fire_department.empty:
+                transformed_dataframes = transform_chunk(raw_fact_fire_department, fields, app_settings,
+                                                         seen_dimension_keys, batch_id, arguments.memory_report)
+            return object_key, object_etag, raw_fact_fire_department, quarantined_rows, transformed_dataframes
+
+        chunks = iter_pending_chunks(s3_client, bucket_name, pending_objects, object_cache, raw_model, quality_rules,
+                                     watermark_id, arguments, app_settings, fields)
+        rows_loaded = 0
+        current_object = None
+        for object_key, object_etag, raw_fact_fire_department, quarantined_rows, transformed_dataframes in run_stages(
+                chunks, [('transform', transform)], arguments, app_settings):
+            if (object_key, object_etag) != current_object:
+                # The bronze and quarantine rows of an object are committed chunk by chunk, long before the object
+                # is recorded after gold. What a failed run committed for it is deleted before its first chunk is
+                # loaded again, whether the failure was raised here or by a pipeline thread
+                current_object = (object_key, object_etag)
+                Utils.delete_unrecorded_object_rows(postgres_connection, object_key, object_etag, 'warehouse',
+                                                    load_bronze)
+            if raw_fact_fire_department is None:
+                # Every chunk of the object went through the stages
+                loaded_objects.append((object_key, object_etag, max_id, max_incident_number, rows_loaded))
+                rows_loaded = 0
+                continue
+
+            if not quarantined_rows.empty:
+                load_quarantined_rows(quarantined_rows, batch_id, 'warehouse', object_key, object_etag, app_settings,
+                                      engine, load_workers)
+            # Bronze and Silver stages
+            if transformed_dataframes is not None:
+                load_chunk(raw_fact_fire_department, transformed_dataframes, object_key, object_etag, app_settings,
+                           engine, load_workers, batch_id, postgres_connection, dimension_key_cache,
+                           arguments.memory_report, load_bronze)
+
+            # The watermark only follows loaded rows, a quarantined row with an outlying id cannot hide later rows
+            max_id = max(max_id, Utils.get_column_max(raw_fact_fire_department, 'id'))
+            max_incident_number = max(max_incident_number,
+                                      Utils.get_column_max(raw_fact_fire_department, 'incident_number'))
+            rows_loaded += len(raw_fact_fire_department)
 
         # GOLD Stage
-        # Writing final/gold data
-        Utils.execute_and_commit_queries(postgres_connection, [dim_batallion_sql_query
-            , dim_district_sql_query
-            , fact_fire_department_injuries_sql_query])
+        # Writing final/gold data, dimensions were merged while resolving the surrogate keys, only the staged fact
+        # rows of this batch are left to append
+        Utils.create_missing_fact_partitions(postgres_connection, batch_id, app_settings.fact_partition_granularity)
+        Utils.execute_gold_merges(postgres_connection, fact_merges, batch_id)
         logging.info(f"Dim and Fact query executed successfully")
+
+        # The batch is merged, staging is emptied so the next run starts from an empty table
+        Utils.execute_and_commit_queries(postgres_connection, [truncate_staging_sql_query])
+
+        if load_bronze:
+            for object_key, object_etag, _, _, rows_loaded in loaded_objects:
+                Utils.check_object_bronze_rows(postgres_connection, object_key, object_etag, rows_loaded)
+
+        # Advance the watermark only once every stage has been committed
+        for object_key, object_etag, object_max_id, object_max_incident_number, rows_loaded in loaded_objects:
+            Utils.record_ingestion_watermark(postgres_connection, object_key, object_etag, object_max_id,
+                                             object_max_incident_number, rows_loaded)
+            if load_bronze:
+                # The raw copy went along, a separate bronze load has nothing left to do for the object
+                Utils.record_ingestion_watermark(postgres_connection, object_key, object_etag, object_max_id,
+                                                 object_max_incident_number, rows_loaded, 'bronze')
         logging.info('The job has finished successfully!')
+        run_status = 'succeeded'
 
     except Exception as error:
         error_msg = f"{sys.exc_info()[0]}, {str(error)}"
         logging.error(error_msg, exc_info=True)
         raise Exception(error_msg) from error
 
+    finally:
+        pipeline_metrics.finish_run(run_status)
+        write_run_metrics(arguments, app_settings, postgres_connection)
+        engine.dispose()
+
 
 if __name__ == "__main__":
     event_stream = None
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Not available on Windows, peak RSS is not reported there
+    resource = None
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):  # Not available on Windows
+    _PAGE_SIZE = None
+
+
+class PipelineMetrics:
+    # Records wall time, CPU time, rows, bytes and peak RSS of every stage of a run. Stages can run on the bulk load
+    # worker threads, records are appended under a lock
+    RSS_SAMPLE_SECONDS = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # [RSS at start, highest RSS seen, process high-water mark at start] of every open stage, keyed by the id of its
+        # record
+        self._rss_windows = {}
+        self._stages_open = threading.Event()
+        self._sampler = None
+        self.start_run()
+
+    def start_run(self, run_id: Optional[str] = None) -> str:
+        with self._lock:
+            self.run_id = run_id or uuid.uuid4().hex
+            self.started_at = datetime.now()
+            self.finished_at = None
+            self.status = 'running'
+            self.attributes = {}
+            self.stages = []
+        return self.run_id
+
+    def finish_run(self, status: str) -> None:
+        self.finished_at = datetime.now()
+        self.status = status
+
+    @staticmethod
+    def get_process_peak_rss_mb() -> Optional[float]:
+        # High-water mark of the whole process, it never goes down so it cannot tell the stages apart
+        if resource is None:
+            return None
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    @staticmethod
+    def get_rss_mb() -> Optional[float]:
+        # Current resident set size, read from /proc on Linux, None elsewhere
+        if _PAGE_SIZE is None:
+            return None
+        try:
+            with open('/proc/self/statm') as statm:
+                return int(statm.read().split()[1]) * _PAGE_SIZE / 1024 / 1024
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _sample_rss(self) -> None:
+        # Raises the peak of every open stage, sleeps while no stage is open
+        while True:
+            self._stages_open.wait()
+            rss = self.get_rss_mb()
+            with self._lock:
+                for window in self._rss_windows.values():
+                    window[1] = max(window[1], rss)
+                if not self._rss_windows:
+                    self._stages_open.clear()
+            time.sleep(self.RSS_SAMPLE_SECONDS)
+
+    def _open_rss_window(self, key: int) -> None:
+        rss = self.get_rss_mb()
+        if rss is None:
+            return
+        with self._lock:
+            self._rss_windows[key] = [rss, rss, self.get_process_peak_rss_mb()]
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, name='metrics-rss-sampler', daemon=True)
+                self._sampler.start()
+        self._stages_open.set()
+
+    def _close_rss_window(self, key: int) -> Tuple[Optional[float], Optional[float]]:
+        # Peak RSS seen while the stage ran and its change over the RSS the stage started with
+        rss = self.get_rss_mb()
+        with self._lock:
+            window = self._rss_windows.pop(key, None)
+        if window is None or rss is None:
+            return None, None
+        start_rss, peak_rss, process_peak_at_start = window
+        peak_rss = max(peak_rss, rss)
+        # A spike shorter than the sampling interval is still caught when it raised the process high-water mark
+        process_peak = self.get_process_peak_rss_mb()
+        if process_peak is not None and process_peak_at_start is not None and process_peak > process_peak_at_start:
+            peak_rss = max(peak_rss, process_peak)
+        return peak_rss, peak_rss - start_rss
+
+    @contextmanager
+    def stage(self, name: str, **attributes) -> Iterator[dict]:
+        # The yielded record can be filled with the rows and bytes the stage handled
+        record = {'stage': name, 'rows': None, 'bytes': None, 'attributes': attributes}
+        started_at = datetime.now()
+        start_wall = time.perf_counter()
+        # CPU time of the calling thread, stages running on worker threads are measured on their own
+        start_cpu = time.thread_time()
+        # Stages running at the same time share the process, each of them sees the memory of the others
+        self._open_rss_window(id(record))
+        status = 'ok'
+        try:
+            yield record
+        except Exception:
+            status = 'failed'
+            raise
+        finally:
+            peak_rss_mb, rss_delta_mb = self._close_rss_window(id(record))
+            record.update({
+                'started_at': started_at.isoformat(),
+                'wall_seconds': time.perf_counter() - start_wall,
+                'cpu_seconds': time.thread_time() - start_cpu,
+                'peak_rss_mb': peak_rss_mb,
+                'rss_delta_mb': rss_delta_mb,
+                'status': status,
+            })
+            with self._lock:
+                self.stages.append(record)
+
+    def get_stage_totals(self) -> Dict[str, dict]:
+        # Stages that run once per chunk or per table are summed by name
+        totals = {}
+        with self._lock:
+            stages = list(self.stages)
+        for record in stages:
+            total = totals.setdefault(record['stage'], {'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                                                        'rows': 0, 'bytes': 0})
+            total['count'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['rows'] += record['rows'] or 0
+            total['bytes'] += record['bytes'] or 0
+        return totals
+
+    def get_report(self) -> dict:
+        with self._lock:
+            stages = list(self.stages)
+        return {
+            'run_id': self.run_id,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'status': self.status,
+            'attributes': self.attributes,
+            'process_peak_rss_mb': self.get_process_peak_rss_mb(),
+            'totals': self.get_stage_totals(),
+            'stages': stages,
+        }
+
+    def write_json_report(self, path: str) -> None:
+        with open(path, 'w') as report_file:
+            json.dump(self.get_report(), report_file, indent=2, default=str)
+        logging.info(f'Run report written to {path}')
+
+    def get_table_rows(self) -> List[tuple]:
+        # One row per stage record, in the column order of pipeline_run_metrics
+        with self._lock:
+            stages = list(self.stages)
+        return [(self.run_id, record['stage'], record['started_at'], record['wall_seconds'], record['cpu_seconds'],
+                 record['rows'], record['bytes'], record['peak_rss_mb'], record['rss_delta_mb'], record['status'],
+                 json.dumps(record['attributes'], default=str))
+                for record in stages]
+
+    def log_summary(self) -> None:
+        for stage_name, total in sorted(self.get_stage_totals().items(), key=lambda item: -item[1]['wall_seconds']):
+            logging.info(f"Stage {stage_name}: {total['count']} call(s), {total['wall_seconds']:.3f}s wall, "
+                         f"{total['cpu_seconds']:.3f}s cpu, {total['rows']} rows, "
+                         f"{total['bytes'] / 1024 / 1024:.2f} MB")
+
+
+# Metrics of the running job, shared by app.py and Utils
+pipeline_metrics = PipelineMetrics()
@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, Optional
+
+
+class S3ObjectCache:
+    # Local copies of S3 objects keyed by bucket, key and ETag. An object overwritten on S3 gets a new ETag, so a
+    # cached copy is never served stale. Least recently used copies are evicted once the cache holds more than
+    # max_bytes. The generator uses the same layout, either app reads what the other one cached
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_path(self, bucket_name: str, key: str, etag: str) -> str:
+        # The extension is kept so readers can tell Parquet from CSV copies
+        object_id = '/'.join((bucket_name, key, etag.strip('"')))
+        digest = hashlib.sha256(object_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + os.path.splitext(key)[1].lower())
+
+    def lookup(self, bucket_name: str, key: str, etag: str) -> Optional[str]:
+        path = self.get_path(bucket_name, key, etag)
+        try:
+            # The modification time is the last use of the copy, eviction removes the oldest first
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        logging.info(f"{key} ({etag}) read from the local object cache")
+        return path
+
+    @contextmanager
+    def writer(self, bucket_name: str, key: str, etag: str) -> Iterator[BinaryIO]:
+        # The copy is written to a temporary file and renamed once complete, a failed or concurrent write never
+        # leaves a partial copy under the final name
+        path = self.get_path(bucket_name, key, etag)
+        temporary_file = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.partial', delete=False)
+        try:
+            with temporary_file:
+                yield temporary_file
+            os.replace(temporary_file.name, path)
+        except BaseException:
+            os.remove(temporary_file.name)
+            raise
+        self.evict(keep_path=path)
+
+    def put_bytes(self, bucket_name: str, key: str, etag: str, body: bytes) -> str:
+        with self.writer(bucket_name, key, etag) as cache_file:
+            cache_file.write(body)
+        return self.get_path(bucket_name, key, etag)
+
+    def evict(self, keep_path: Optional[str] = None) -> None:
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and not entry.name.endswith('.partial'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # The copy just written is kept even on its own above max_bytes, the next write evicts it
+            if path == keep_path:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
@@ -0,0 +1,125 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, Tuple
+from fire_department.metrics import pipeline_metrics
+
+# Marks the end of the items of a queue
+_END = object()
+
+
+class _StageFailure:
+    # Sent downstream in place of an item when a stage raised, every later stage forwards it and stops
+    def __init__(self, stage_name: str, error: BaseException):
+        self.stage_name = stage_name
+        self.error = error
+
+
+class StagePipeline:
+    # Runs the source iterator and every stage on their own thread, joined by bounded queues. A stage blocks once the
+    # next queue is full, so a slow consumer holds back the producers instead of letting chunks pile up in memory.
+    # The last stage is the caller iterating the pipeline, it stays on the calling thread. Items keep their order
+    POLL_SECONDS = 0.1
+
+    def __init__(self, source: Iterable, stages: List[Tuple[str, Callable]], queue_size: int = 2):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stop = threading.Event()
+
+    def _put(self, output_queue: queue.Queue, item) -> bool:
+        # False when the pipeline was stopped while waiting for room in the queue
+        while not self._stop.is_set():
+            try:
+                output_queue.put(item, timeout=self.POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, input_queue: queue.Queue):
+        while not self._stop.is_set():
+            try:
+                return input_queue.get(timeout=self.POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _END
+
+    def _run_source(self, output_queue: queue.Queue) -> None:
+        with pipeline_metrics.stage('pipeline_source') as record:
+            blocked_seconds = 0.0
+            items = 0
+            try:
+                for item in self.source:
+                    start = time.perf_counter()
+                    if not self._put(output_queue, item):
+                        return
+                    blocked_seconds += time.perf_counter() - start
+                    items += 1
+                self._put(output_queue, _END)
+            except BaseException as error:
+                logging.error(f"Pipeline source failed: {error}")
+                self._put(output_queue, _StageFailure('source', error))
+            finally:
+                # Lets the source release what it holds, e.g. a temporary download file, when it was not exhausted
+                close = getattr(self.source, 'close', None)
+                if close is not None:
+                    close()
+                record['rows'] = items
+                record['attributes']['blocked_seconds'] = blocked_seconds
+
+    def _run_stage(self, stage_name: str, function: Callable, input_queue: queue.Queue,
+                   output_queue: queue.Queue) -> None:
+        with pipeline_metrics.stage(f'pipeline_{stage_name}') as record:
+            idle_seconds = 0.0
+            blocked_seconds = 0.0
+            items = 0
+            while True:
+                start = time.perf_counter()
+                item = self._get(input_queue)
+                idle_seconds += time.perf_counter() - start
+                if item is _END or isinstance(item, _StageFailure):
+                    self._put(output_queue, item)
+                    break
+                try:
+                    result = function(item)
+                except BaseException as error:
+                    logging.error(f"Pipeline stage {stage_name} failed: {error}")
+                    self._put(output_queue, _StageFailure(stage_name, error))
+                    break
+                start = time.perf_counter()
+                if not self._put(output_queue, result):
+                    break
+                blocked_seconds += time.perf_counter() - start
+                items += 1
+            record['rows'] = items
+            # Waiting on the previous stage (idle) or on the next one (blocked), the stage with neither is the
+            # bottleneck
+            record['attributes'].update(idle_seconds=idle_seconds, blocked_seconds=blocked_seconds)
+
+    def __iter__(self) -> Iterator:
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(queues[0],), name='pipeline-source', daemon=True)]
+        for index, (stage_name, function) in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._run_stage,
+                                            args=(stage_name, function, queues[index], queues[index + 1]),
+                                            name=f'pipeline-{stage_name}', daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END:
+                    return
+                if isinstance(item, _StageFailure):
+                    # The error of the stage is raised as is, as the sequential run would
+                    raise item.error
+                yield item
+        finally:
+            # Reached on completion, on a failure and when the caller stops early or raises, every thread is
+            # unblocked and waited for so nothing keeps running behind the caller
+            self._stop.set()
+            for thread in threads:
+                thread.join()
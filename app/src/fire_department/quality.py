@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple, get_args, get_type_hints
+import numpy as np
+import pandas as pd
+from fire_department.utils import Utils
+
+
+@dataclass(frozen=True)
+class QualityRule:
+    column: str
+    reason_code: str
+    # Mask of the rows failing the rule, computed on the whole column at once. It also receives the coercion failure
+    # mask of the column, if any
+    check: Callable[[pd.Series, Optional[pd.Series]], pd.Series]
+
+
+class DataQualityRules:
+    # Rules compiled once from the model annotations and the declarative constraints of the columns. Only the
+    # constrained columns are checked, including their type, other columns keep being coerced to null with a warning
+    constraint_keys = {'nullable', 'min', 'max', 'allowed', 'unique'}
+
+    def __init__(self, model, constraints: Dict[str, dict]):
+        column_types = Utils.get_model_column_types(model)
+        annotations = get_type_hints(model)
+        self.rules: List[QualityRule] = []
+        for column, constraint in constraints.items():
+            unknown_keys = set(constraint) - self.constraint_keys
+            if unknown_keys:
+                raise ValueError(f"Unknown data quality constraints on {column}: {unknown_keys}")
+            # Columns left out of a projected model are not checked
+            if column not in column_types:
+                continue
+            nullable = constraint.get('nullable', type(None) in get_args(annotations[column]))
+            self.rules.extend(self.compile_column_rules(column, nullable, constraint))
+
+    @staticmethod
+    def compile_column_rules(column: str, nullable: bool, constraint: dict) -> List[QualityRule]:
+        # Comparisons are false on nulls, a null only fails the nullability rule
+        rules = [QualityRule(column, f'{column}:type', lambda series, failed: failed)]
+        if not nullable:
+            rules.append(QualityRule(column, f'{column}:null', lambda series, failed: series.isna()))
+        if 'min' in constraint:
+            rules.append(QualityRule(column, f'{column}:below_min',
+                                     lambda series, failed, minimum=constraint['min']: series < minimum))
+        if 'max' in constraint:
+            rules.append(QualityRule(column, f'{column}:above_max',
+                                     lambda series, failed, maximum=constraint['max']: series > maximum))
+        if 'allowed' in constraint:
+            rules.append(QualityRule(column, f'{column}:not_allowed',
+                                     lambda series, failed, allowed=tuple(constraint['allowed']):
+                                     series.notna() & ~series.isin(allowed)))
+        if constraint.get('unique'):
+            # Repeated values within the frame, the first occurrence is kept
+            rules.append(QualityRule(column, f'{column}:duplicate',
+                                     lambda series, failed: series.notna() & series.duplicated(keep='first')))
+        return rules
+
+    @staticmethod
+    def get_records(dataframe: pd.DataFrame) -> List[str]:
+        # One JSON document per row, timestamps keep their microseconds
+        if dataframe.empty:
+            return []
+        return dataframe.to_json(orient='records', lines=True, date_format='iso', date_unit='us').splitlines()
+
+    def split(self, dataframe: pd.DataFrame, coercion_failures: Dict[str, pd.Series],
+              source_dataframe: Optional[pd.DataFrame] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        # Returns the rows passing every rule and the failing rows with their ';' separated reason_codes and their
+        # record as JSON. The record is taken from source_dataframe, the frame before coercion, when it is given, so
+        # a value that could not be parsed is kept as it was read
+        masks = []
+        for rule in self.rules:
+            mask = rule.check(dataframe[rule.column], coercion_failures.get(rule.column))
+            if mask is not None:
+                mask = mask.to_numpy(dtype=bool, na_value=False)
+                if mask.any():
+                    masks.append((rule.reason_code, mask))
+
+        if not masks:
+            return dataframe, dataframe.iloc[:0].assign(reason_codes=pd.Series([], dtype=object),
+                                                        record=pd.Series([], dtype=object))
+
+        failing = np.logical_or.reduce([mask for _, mask in masks])
+        # Reason codes are only built for the failing rows
+        reason_codes = np.full(int(failing.sum()), '', dtype=object)
+        for reason_code, mask in masks:
+            reason_codes = np.where(mask[failing], reason_codes + reason_code + ';', reason_codes)
+        source_rows = (dataframe if source_dataframe is None else source_dataframe)[failing]
+        return dataframe[~failing], dataframe[failing].assign(
+            reason_codes=pd.Series(reason_codes, index=dataframe.index[failing], dtype=object).str.rstrip(';'),
+            record=pd.Series(self.get_records(source_rows), index=dataframe.index[failing], dtype=object))
+
+    @staticmethod
+    def create_quarantine_dataframe(quarantined_rows: pd.DataFrame, batch_id: Optional[int], stage: str,
+                                    object_key: str, object_etag: str) -> pd.DataFrame:
+        # One row per failing record in the column order of the quarantine table
+        return pd.DataFrame({
+            'batch_id': pd.array([batch_id] * len(quarantined_rows), dtype='Int64'),
+            'stage': stage,
+            'object_key': object_key,
+            'object_etag': object_etag,
+            'id': quarantined_rows['id'].astype('Int64') if 'id' in quarantined_rows else pd.NA,
+            'incident_number': quarantined_rows['incident_number'].astype('Int64')
+            if 'incident_number' in quarantined_rows else pd.NA,
+            'reason_codes': quarantined_rows['reason_codes'],
+            'record': quarantined_rows['record'],
+            'quarantined_at': pd.Timestamp.now(),
+        }, index=quarantined_rows.index)
@@ -16,7 +16,7 @@ class RawFireDepartmentModel:
     city: Optional[str]
     zipcode: Optional[str]
     battalion: Optional[str]
-    station_area: Optional[int]
+    station_area: Optional[str]
     box: Optional[str]
     suppression_units: Optional[int]
     suppression_personnel: Optional[int]
@@ -0,0 +1,16 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class QuarantineModel:
+    batch_id: Optional[int]
+    stage: Optional[str]
+    object_key: Optional[str]
+    object_etag: Optional[str]
+    id: Optional[int]
+    incident_number: Optional[int]
+    reason_codes: Optional[str]
+    record: Optional[str]
+    quarantined_at: Optional[datetime]
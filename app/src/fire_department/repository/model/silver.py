@@ -23,14 +23,21 @@ class StgFireDepartmentModel():
     civilian_fatalities: Optional[int]
     civilian_injuries: Optional[int]
     number_of_alarms: Optional[int]
+    batch_id: Optional[int]
+    dim_battalion_sk: Optional[int]
+    dim_district_sk: Optional[int]
 
 
 @dataclass
 class StgDistrictModel:
     neighborhood_district: Optional[str]
     city: Optional[str]
+    batch_id: Optional[int]
+    row_hash: Optional[int]
 
 
 @dataclass
 class StgBattalionModel:
     battalion: Optional[str]
+    batch_id: Optional[int]
+    row_hash: Optional[int]
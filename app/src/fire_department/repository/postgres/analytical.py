@@ -0,0 +1,38 @@
+# Reference queries on the fact table, checked with EXPLAIN by the --explain-check mode of the job
+incidents_by_day_of_week_sql_query = """
+ SELECT dd.day_name, count(*) AS incident_count
+ FROM fact_fire_department_injuries fact
+ JOIN dim_date dd ON fact.date_dim_id = dd.date_dim_id
+ GROUP BY dd.day_name, dd.day_of_week
+ ORDER BY dd.day_of_week;
+ """
+
+alarms_by_battalion_of_a_month_sql_query = """
+ SELECT db.battalion, avg(fact.num_alarms) AS avg_alarms
+ FROM fact_fire_department_injuries fact
+ JOIN dim_battalion db ON fact.dim_battalion_sk = db.dim_battalion_sk
+ WHERE fact.incident_date >= '2024-01-01'
+   AND fact.incident_date < '2024-02-01'
+ GROUP BY db.battalion;
+ """
+
+incidents_by_district_of_a_day_sql_query = """
+ SELECT dd.neighborhood_district, count(*) AS incident_count
+ FROM fact_fire_department_injuries fact
+ JOIN dim_district dd ON fact.dim_district_sk = dd.dim_district_sk
+ WHERE fact.date_dim_id = 20240115
+   AND fact.incident_date >= '2024-01-15'
+   AND fact.incident_date < '2024-01-16'
+ GROUP BY dd.neighborhood_district;
+ """
+
+# Name, query, plan nodes of which at least one is expected (None to skip) and the maximum number of fact partitions
+# the plan may scan (None to skip). Join and index conditions are also expected to be free of date casts
+explain_checks = [
+    ('incidents_by_day_of_week', incidents_by_day_of_week_sql_query,
+     ('Hash Join', 'Merge Join', 'Index Scan', 'Index Only Scan'), None),
+    ('alarms_by_battalion_of_a_month', alarms_by_battalion_of_a_month_sql_query,
+     None, 1),
+    ('incidents_by_district_of_a_day', incidents_by_district_of_a_day_sql_query,
+     ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'), 1),
+]
@@ -1 +1,33 @@
+# Rows an earlier run committed for an object it did not finish, deleted before the object is loaded again
+delete_object_bronze_sql_queries = [
+    """
+ DELETE FROM public.raw_dim_battalion
+ WHERE object_key = %s
+   AND object_etag = %s;
+ """,
+    """
+ DELETE FROM public.raw_dim_district
+ WHERE object_key = %s
+   AND object_etag = %s;
+ """,
+    """
+ DELETE FROM public.raw_fact_fire_department
+ WHERE object_key = %s
+   AND object_etag = %s;
+ """,
+]
 
+delete_object_quarantine_sql_query = """
+ DELETE FROM public.dq_quarantine
+ WHERE object_key = %s
+   AND object_etag = %s
+   AND stage = %s;
+ """
+
+# Rows the bronze copy of an object holds, compared with the rows the run loaded for it
+object_bronze_row_count_sql_query = """
+ SELECT count(*)
+ FROM public.raw_fact_fire_department
+ WHERE object_key = %s
+   AND object_etag = %s;
+ """
@@ -0,0 +1,30 @@
+# Ingestion control queries
+ingestion_manifest_object_loaded_sql_query = """
+ SELECT count(*)
+ FROM public.etl_ingestion_manifest
+ WHERE object_key = %s
+   AND etag = %s
+   AND stage = %s;
+ """
+
+ingestion_watermark_sql_query = """
+ SELECT coalesce(max(max_id), 0), coalesce(max(max_incident_number), 0)
+ FROM public.etl_ingestion_manifest
+ WHERE stage = %s;
+ """
+
+insert_ingestion_manifest_sql_query = """
+ INSERT INTO public.etl_ingestion_manifest (object_key, etag, max_id, max_incident_number, rows_loaded, stage)
+ VALUES (%s, %s, %s, %s, %s, %s)
+ ON CONFLICT (object_key, etag, stage) DO NOTHING;
+ """
+
+next_batch_id_sql_query = """
+ SELECT nextval('public.etl_batch_id_seq');
+ """
+
+insert_pipeline_run_metrics_sql_query = """
+ INSERT INTO public.pipeline_run_metrics (run_id, stage, started_at, wall_seconds, cpu_seconds, rows, bytes,
+                                          peak_rss_mb, rss_delta_mb, status, attributes)
+ VALUES (%s, %s, %s::timestamp, %s, %s, %s, %s, %s, %s, %s, %s::jsonb);
+ """
@@ -1,29 +1,130 @@
 # Final Dim and Fact Queries
+# Every merge only reads the staging rows of the current batch, %s is the batch id.
+# Dimension members are compared through the row_hash computed over their attributes in the silver stage, only new
+# or changed members are written. One staged row per natural key is kept, a key cannot be written twice by a statement.
+# A district staged with several cities keeps the one of its current version when the batch holds it, so the member
+# does not flip between them from one batch to the next
+# The merges return how many rows they inserted and updated
+
+# Type 1, changed members are overwritten in place
 dim_batallion_sql_query = """
- INSERT INTO public.dim_battalion (battalion)
- SELECT battalion
+ WITH merged AS (
+ INSERT INTO public.dim_battalion AS dim (battalion, row_hash)
+ SELECT DISTINCT ON (battalion) battalion, row_hash
  FROM stg_dim_battalion
- ON CONFLICT (battalion) DO NOTHING;
+ WHERE batch_id = %s
+   AND battalion IS NOT NULL
+ ORDER BY battalion, row_hash
+ ON CONFLICT (battalion) WHERE is_current DO UPDATE SET
+   row_hash = EXCLUDED.row_hash
+ WHERE dim.row_hash IS DISTINCT FROM EXCLUDED.row_hash
+ RETURNING (xmax = 0) AS is_insert
+ )
+ SELECT count(*) FILTER (WHERE is_insert), count(*) FILTER (WHERE NOT is_insert) FROM merged;
  """
 dim_district_sql_query = """
- INSERT INTO public.dim_district(neighborhood_district, city,city_cleaned)
- SELECT neighborhood_district, city,city_cleaned
- FROM stg_dim_district
- ON CONFLICT (neighborhood_district) DO NOTHING;
+ WITH merged AS (
+ INSERT INTO public.dim_district AS dim (neighborhood_district, city, city_cleaned, row_hash)
+ SELECT DISTINCT ON (stg.neighborhood_district) stg.neighborhood_district, stg.city, stg.city_cleaned, stg.row_hash
+ FROM stg_dim_district stg
+ LEFT JOIN public.dim_district current_dim
+   ON current_dim.neighborhood_district = stg.neighborhood_district
+  AND current_dim.is_current
+ WHERE stg.batch_id = %s
+   AND stg.neighborhood_district IS NOT NULL
+ ORDER BY stg.neighborhood_district, stg.row_hash IS NOT DISTINCT FROM current_dim.row_hash DESC, stg.city,
+          stg.city_cleaned
+ ON CONFLICT (neighborhood_district) WHERE is_current DO UPDATE SET
+   city = EXCLUDED.city,
+   city_cleaned = EXCLUDED.city_cleaned,
+   row_hash = EXCLUDED.row_hash
+ WHERE dim.row_hash IS DISTINCT FROM EXCLUDED.row_hash
+ RETURNING (xmax = 0) AS is_insert
+ )
+ SELECT count(*) FILTER (WHERE is_insert), count(*) FILTER (WHERE NOT is_insert) FROM merged;
  """
 
+# Type 2, the current version of a changed member is closed and a new version with its own surrogate key is opened.
+# Facts keep pointing to the version that was current when they were loaded
+dim_battalion_scd2_sql_query = """
+ WITH incoming AS (
+ SELECT DISTINCT ON (battalion) battalion, row_hash
+ FROM stg_dim_battalion
+ WHERE batch_id = %s
+   AND battalion IS NOT NULL
+ ORDER BY battalion, row_hash
+ ),
+ expired AS (
+ UPDATE public.dim_battalion dim
+ SET is_current = false, valid_to = now()
+ FROM incoming
+ WHERE dim.battalion = incoming.battalion
+   AND dim.is_current
+   AND dim.row_hash IS DISTINCT FROM incoming.row_hash
+ RETURNING dim.battalion
+ ),
+ inserted AS (
+ INSERT INTO public.dim_battalion (battalion, row_hash)
+ SELECT incoming.battalion, incoming.row_hash
+ FROM incoming
+ WHERE incoming.battalion IN (SELECT battalion FROM expired)
+    OR NOT EXISTS (SELECT 1 FROM public.dim_battalion dim WHERE dim.battalion = incoming.battalion AND dim.is_current)
+ RETURNING battalion
+ )
+ SELECT count(*) FILTER (WHERE battalion NOT IN (SELECT battalion FROM expired)),
+        count(*) FILTER (WHERE battalion IN (SELECT battalion FROM expired))
+ FROM inserted;
+ """
+dim_district_scd2_sql_query = """
+ WITH incoming AS (
+ SELECT DISTINCT ON (stg.neighborhood_district) stg.neighborhood_district, stg.city, stg.city_cleaned, stg.row_hash
+ FROM stg_dim_district stg
+ LEFT JOIN public.dim_district current_dim
+   ON current_dim.neighborhood_district = stg.neighborhood_district
+  AND current_dim.is_current
+ WHERE stg.batch_id = %s
+   AND stg.neighborhood_district IS NOT NULL
+ ORDER BY stg.neighborhood_district, stg.row_hash IS NOT DISTINCT FROM current_dim.row_hash DESC, stg.city,
+          stg.city_cleaned
+ ),
+ expired AS (
+ UPDATE public.dim_district dim
+ SET is_current = false, valid_to = now()
+ FROM incoming
+ WHERE dim.neighborhood_district = incoming.neighborhood_district
+   AND dim.is_current
+   AND dim.row_hash IS DISTINCT FROM incoming.row_hash
+ RETURNING dim.neighborhood_district
+ ),
+ inserted AS (
+ INSERT INTO public.dim_district (neighborhood_district, city, city_cleaned, row_hash)
+ SELECT incoming.neighborhood_district, incoming.city, incoming.city_cleaned, incoming.row_hash
+ FROM incoming
+ WHERE incoming.neighborhood_district IN (SELECT neighborhood_district FROM expired)
+    OR NOT EXISTS (SELECT 1 FROM public.dim_district dim
+                   WHERE dim.neighborhood_district = incoming.neighborhood_district AND dim.is_current)
+ RETURNING neighborhood_district
+ )
+ SELECT count(*) FILTER (WHERE neighborhood_district NOT IN (SELECT neighborhood_district FROM expired)),
+        count(*) FILTER (WHERE neighborhood_district IN (SELECT neighborhood_district FROM expired))
+ FROM inserted;
+ """
+
+# Surrogate keys are resolved by the job, the staged fact rows already carry them and the insert is a plain append.
+# Only the rows actually inserted are returned and folded into the daily rollup, the statement returns their count
 fact_fire_department_injuries_sql_query = """
+ WITH inserted AS (
  insert into fact_fire_department_injuries (incident_number, id, incident_date, dim_battalion_sk, dim_district_sk,
                                             suppression_units, suppression_personnel, ems_units, ems_personnel,
                                             other_units, other_personnel, estimated_property_loss,
                                             estimated_contents_loss, fire_fatalities, fire_injuries, civilian_fatalities,
-                                            civilian_injuries, num_alarms)
+                                            civilian_injuries, num_alarms, date_dim_id)
  SELECT
    incident_number,
    id,
    incident_date,
-   sdb.dim_battalion_sk,
-   dd.dim_district_sk,
+   dim_battalion_sk,
+   dim_district_sk,
    suppression_units,
    suppression_personnel,
    ems_units,
@@ -36,9 +137,165 @@ fact_fire_department_injuries_sql_query = """
    fire_injuries,
    civilian_fatalities,
    civilian_injuries,
-   num_alarms
- FROM stg_fact_fire_department_injuries fact
- LEFT JOIN public.dim_battalion sdb on fact.battalion = sdb.battalion
- LEFT JOIN public.dim_district dd on fact.neighborhood_district = dd.neighborhood_district
- ON CONFLICT (id) DO NOTHING;
- """
\ No newline at end of file
+   num_alarms,
+   -- Integer yyyymmdd key of dim_date, joins on it need no per row cast of the timestamp
+   TO_CHAR(incident_date, 'yyyymmdd')::INT
+ FROM stg_fact_fire_department_injuries
+ WHERE batch_id = %s
+ ON CONFLICT (id, incident_date) DO NOTHING
+ RETURNING *
+ ),
+ rollup AS (
+ INSERT INTO agg_fire_department_injuries_daily AS agg (date_dim_id, dim_battalion_sk, dim_district_sk,
+                                                       incident_count, num_alarms_sum, num_alarms_count,
+                                                       estimated_property_loss_sum, personnel_response_sum,
+                                                       personnel_response_count, fire_fatalities_sum,
+                                                       civilian_fatalities_sum)
+ SELECT
+   date_dim_id,
+   dim_battalion_sk,
+   dim_district_sk,
+   count(*),
+   sum(num_alarms),
+   count(num_alarms),
+   sum(estimated_property_loss),
+   sum(suppression_personnel + ems_personnel + other_personnel),
+   count(suppression_personnel + ems_personnel + other_personnel),
+   sum(fire_fatalities),
+   sum(civilian_fatalities)
+ FROM inserted
+ WHERE date_dim_id IS NOT NULL
+ GROUP BY 1, 2, 3
+ ON CONFLICT (date_dim_id, dim_battalion_sk, dim_district_sk) DO UPDATE SET
+   incident_count = agg.incident_count + EXCLUDED.incident_count,
+   num_alarms_sum = coalesce(agg.num_alarms_sum, 0) + coalesce(EXCLUDED.num_alarms_sum, 0),
+   num_alarms_count = agg.num_alarms_count + EXCLUDED.num_alarms_count,
+   estimated_property_loss_sum = coalesce(agg.estimated_property_loss_sum, 0)
+                                 + coalesce(EXCLUDED.estimated_property_loss_sum, 0),
+   personnel_response_sum = coalesce(agg.personnel_response_sum, 0) + coalesce(EXCLUDED.personnel_response_sum, 0),
+   personnel_response_count = agg.personnel_response_count + EXCLUDED.personnel_response_count,
+   fire_fatalities_sum = coalesce(agg.fire_fatalities_sum, 0) + coalesce(EXCLUDED.fire_fatalities_sum, 0),
+   civilian_fatalities_sum = coalesce(agg.civilian_fatalities_sum, 0) + coalesce(EXCLUDED.civilian_fatalities_sum, 0)
+ )
+ SELECT count(*) FROM inserted;
+ """
+
+# Staged rows of the batch and how many of them already exist in the target, run before each merge
+dim_battalion_merge_stats_sql_query = """
+ SELECT count(*),
+        count(*) FILTER (WHERE EXISTS (SELECT 1 FROM public.dim_battalion dim
+                                       WHERE dim.battalion = stg.battalion AND dim.is_current))
+ FROM stg_dim_battalion stg
+ WHERE stg.batch_id = %s
+   AND stg.battalion IS NOT NULL;
+ """
+dim_district_merge_stats_sql_query = """
+ SELECT count(*),
+        count(*) FILTER (WHERE EXISTS (SELECT 1 FROM public.dim_district dim
+                                       WHERE dim.neighborhood_district = stg.neighborhood_district
+                                         AND dim.is_current))
+ FROM stg_dim_district stg
+ WHERE stg.batch_id = %s
+   AND stg.neighborhood_district IS NOT NULL;
+ """
+fact_fire_department_injuries_merge_stats_sql_query = """
+ SELECT count(*),
+        count(*) FILTER (WHERE EXISTS (SELECT 1 FROM public.fact_fire_department_injuries fact
+                                       WHERE fact.id = stg.id
+                                         AND fact.incident_date IS NOT DISTINCT FROM stg.incident_date))
+ FROM stg_fact_fire_department_injuries stg
+ WHERE stg.batch_id = %s;
+ """
+
+# Range partitions of the fact needed by the batch, %s are the granularity (month or year) and the batch id
+fact_partition_bounds_sql_query = """
+ SELECT DISTINCT date_trunc(%s, incident_date) AS range_start,
+                 date_trunc(%s, incident_date) + ('1 ' || %s)::interval AS range_end
+ FROM stg_fact_fire_department_injuries
+ WHERE batch_id = %s
+   AND incident_date IS NOT NULL
+ ORDER BY range_start;
+ """
+create_fact_partition_sql_query = """
+ CREATE TABLE IF NOT EXISTS public.{partition_name}
+ PARTITION OF public.fact_fire_department_injuries
+ FOR VALUES FROM ('{range_start}') TO ('{range_end}');
+ """
+
+# Indexes of the fact, created on the partitioned table so every partition, present or future, gets them.
+# BRIN stays tiny on the append ordered incident_date, B-trees serve the integer join keys
+fact_index_sql_queries = [
+    """
+ CREATE INDEX IF NOT EXISTS fact_fire_department_injuries_incident_date_brin
+ ON public.fact_fire_department_injuries USING brin (incident_date);
+ """,
+    """
+ CREATE INDEX IF NOT EXISTS fact_fire_department_injuries_date_dim_id_idx
+ ON public.fact_fire_department_injuries (date_dim_id);
+ """,
+    """
+ CREATE INDEX IF NOT EXISTS fact_fire_department_injuries_dim_battalion_sk_idx
+ ON public.fact_fire_department_injuries (dim_battalion_sk);
+ """,
+    """
+ CREATE INDEX IF NOT EXISTS fact_fire_department_injuries_dim_district_sk_idx
+ ON public.fact_fire_department_injuries (dim_district_sk);
+ """,
+]
+
+# Natural key to surrogate key maps of the dimensions, loaded once and refreshed only when new members show up
+dim_battalion_keys_sql_query = """
+ SELECT battalion, dim_battalion_sk
+ FROM public.dim_battalion
+ WHERE battalion IS NOT NULL
+   AND is_current;
+ """
+dim_district_keys_sql_query = """
+ SELECT neighborhood_district, dim_district_sk
+ FROM public.dim_district
+ WHERE neighborhood_district IS NOT NULL
+   AND is_current;
+ """
+
+# Member every unresolved fact row points to, %s is the configured unknown surrogate key
+dim_battalion_unknown_member_sql_query = """
+ INSERT INTO public.dim_battalion (dim_battalion_sk, battalion)
+ OVERRIDING SYSTEM VALUE
+ VALUES (%s, 'UNKNOWN')
+ ON CONFLICT DO NOTHING;
+ """
+dim_district_unknown_member_sql_query = """
+ INSERT INTO public.dim_district (dim_district_sk, neighborhood_district, city, city_cleaned)
+ OVERRIDING SYSTEM VALUE
+ VALUES (%s, 'UNKNOWN', 'UNKNOWN', 'U')
+ ON CONFLICT DO NOTHING;
+ """
+
+# Target table, stats query and merge query, in the order they have to run. Dimension merges by SCD type
+dimension_merges = {
+    1: [
+        ('dim_battalion', dim_battalion_merge_stats_sql_query, dim_batallion_sql_query),
+        ('dim_district', dim_district_merge_stats_sql_query, dim_district_sql_query),
+    ],
+    2: [
+        ('dim_battalion', dim_battalion_merge_stats_sql_query, dim_battalion_scd2_sql_query),
+        ('dim_district', dim_district_merge_stats_sql_query, dim_district_scd2_sql_query),
+    ],
+}
+fact_merges = [
+    ('fact_fire_department_injuries', fact_fire_department_injuries_merge_stats_sql_query,
+     fact_fire_department_injuries_sql_query),
+]
+
+# Dimension table, natural key in the staged fact, surrogate key, key map query and unknown member query
+dimension_keys = [
+    ('dim_battalion', 'battalion', 'dim_battalion_sk', dim_battalion_keys_sql_query,
+     dim_battalion_unknown_member_sql_query),
+    ('dim_district', 'neighborhood_district', 'dim_district_sk', dim_district_keys_sql_query,
+     dim_district_unknown_member_sql_query),
+]
+
+# Staging tables are emptied once the batch is merged
+truncate_staging_sql_query = """
+ TRUNCATE TABLE stg_dim_battalion, stg_dim_district, stg_fact_fire_department_injuries;
+ """
@@ -13,7 +13,26 @@ class AppSettings:
         "db_port",
         "db_name",
         "db_user",
-        "db_password"
+        "db_password",
+        "incremental_ingestion",
+        "load_workers",
+        "manifest_file_name",
+        "unknown_dimension_sk",
+        "fact_partition_granularity",
+        "dimension_scd_type",
+        "categorical_encoding",
+        "categorical_max_unique_ratio",
+        "bronze_load",
+        "metrics_report_path",
+        "metrics_to_postgres",
+        "s3_download_part_size",
+        "s3_download_concurrency",
+        "s3_cache_dir",
+        "s3_cache_max_bytes",
+        "data_quality_checks",
+        "quarantine_table_name",
+        "pipelined_execution",
+        "pipeline_queue_size"
 
     ]
 
@@ -34,6 +53,45 @@ class AppSettings:
         self.db_name = "mydatabase"
         self.db_user = "myuser"
         self.db_password = "mypassword"
+        # Only rows above the persisted id watermark are pushed through the stages
+        self.incremental_ingestion = True
+        # Tables of a layer are loaded concurrently by this many workers
+        self.load_workers = 3
+        # Manifest of the data objects written by the generator
+        self.manifest_file_name = "manifest/manifest.json"
+        # Surrogate key of the dimension member fact rows point to when their natural key is missing or unknown
+        self.unknown_dimension_sk = -1
+        # Range partitions of the fact table by incident_date, month or year. It cannot change once partitions exist
+        self.fact_partition_granularity = "month"
+        # Changed dimension members are overwritten (1) or versioned (2)
+        self.dimension_scd_type = 1
+        # Low cardinality raw text columns are held as pandas categoricals, the declared raw_categorical_fields and
+        # any other text column with at most this ratio of distinct values per row
+        self.categorical_encoding = True
+        self.categorical_max_unique_ratio = 0.01
+        # The job loads the raw bronze copy along with silver and gold. When False only the columns silver and gold
+        # need are read, and the raw copy is left to a separately scheduled --bronze-only run
+        self.bronze_load = True
+        # Stage timings of the run are written as a JSON report to this path (None to skip) and to the
+        # pipeline_run_metrics table
+        self.metrics_report_path = None
+        self.metrics_to_postgres = False
+        # Whole S3 objects are downloaded with concurrent ranged GETs of this many bytes, by this many threads
+        self.s3_download_part_size = 8 * 1024 * 1024
+        self.s3_download_concurrency = 8
+        # Local copies of the S3 objects, keyed by bucket, key and ETag and shared with the generator. Least recently
+        # used copies are evicted above s3_cache_max_bytes. None disables the cache
+        self.s3_cache_dir = "~/.cache/fire-department/s3"
+        self.s3_cache_max_bytes = 2 * 1024 * 1024 * 1024
+        # Raw fact rows are checked against FieldSettings.raw_fact_quality_constraints, failing rows are written to the
+        # quarantine table with their reason codes instead of being loaded
+        self.data_quality_checks = True
+        self.quarantine_table_name = "dq_quarantine"
+        # Reading and decoding the S3 objects, the dataframe transforms and the database loads run as overlapping stages
+        # on their own threads. Each stage holds at most pipeline_queue_size chunks ready for the next one, so memory
+        # stays bounded when a stage is slower than the others
+        self.pipelined_execution = True
+        self.pipeline_queue_size = 2
 
 
 
@@ -4,7 +4,11 @@ class FieldSettings:
         "raw_dim_battalion_fields",
         "stg_fact_fire_fighters_injured_fields",
         "dim_district_fields",
-        "dim_battalion_fields"
+        "dim_battalion_fields",
+        "stg_dim_district_hash_fields",
+        "stg_dim_battalion_hash_fields",
+        "raw_categorical_fields",
+        "raw_fact_quality_constraints"
     )
 
     def __init__(
@@ -24,6 +28,47 @@ class FieldSettings:
         self.stg_fact_fire_fighters_injured_fields = stg_fact_fire_fighters_injured_fields
         self.dim_district_fields = Fields(raw_dim_district_fields)
         self.dim_battalion_fields = Fields(raw_dim_battalion_fields)
+        # Columns a dimension member is compared on, new attributes have to be added here to be tracked. Districts are
+        # compared on the normalized city, spellings of the same city ('SF', 'San Francisco') are not a change
+        self.stg_dim_district_hash_fields = ['neighborhood_district', 'city_cleaned']
+        self.stg_dim_battalion_hash_fields = ['battalion']
+        # Raw text columns holding a handful of codes, they are dictionary encoded as pandas categoricals when read
+        self.raw_categorical_fields = ['city', 'zipcode', 'battalion', 'box', 'first_unit_on_scene',
+                                       'primary_situation', 'mutual_aid', 'action_taken_primary',
+                                       'action_taken_secondary', 'action_taken_other', 'detector_alerted_occupants',
+                                       'property_use', 'area_of_fire_origin', 'ignition_cause',
+                                       'ignition_factor_primary', 'ignition_factor_secondary', 'heat_source',
+                                       'item_first_ignited', 'human_factors_associated_with_ignition',
+                                       'structure_type', 'structure_status', 'floor_of_fire_origin', 'fire_spread',
+                                       'no_flame_spead', 'detectors_present', 'detector_type', 'detector_operation',
+                                       'detector_effectiveness', 'detector_failure_reason',
+                                       'automatic_extinguishing_system_present',
+                                       'automatic_extinguishing_sytem_type',
+                                       'automatic_extinguishing_sytem_perfomance',
+                                       'automatic_extinguishing_sytem_failure_reason', 'neighborhood_district']
+        # Declarative data quality constraints of the raw fact columns, rows failing any of them are quarantined
+        # instead of loaded. Keys: nullable (defaults to the model annotation), min, max, allowed and unique (within
+        # the rows read together). A constrained column whose value cannot be parsed to its type fails as well
+        count_constraint = {'min': 0}
+        self.raw_fact_quality_constraints = {
+            'id': {'nullable': False, 'unique': True, 'min': 1},
+            'incident_number': {'nullable': False, 'min': 1},
+            # The days dim_date holds (bin/init.sql), the fact references it through date_dim_id
+            'incident_date': {'min': '1970-01-01', 'max': '2049-12-31 23:59:59.999999'},
+            'suppression_units': count_constraint,
+            'suppression_personnel': count_constraint,
+            'ems_units': count_constraint,
+            'ems_personnel': count_constraint,
+            'other_units': count_constraint,
+            'other_personnel': count_constraint,
+            'estimated_property_loss': {'min': 0},
+            'estimated_contents_loss': {'min': 0},
+            'fire_fatalities': count_constraint,
+            'fire_injuries': count_constraint,
+            'civilian_fatalities': count_constraint,
+            'civilian_injuries': count_constraint,
+            'number_of_alarms': {'allowed': [1, 2, 3, 4, 5]},
+        }
 
 
 class Fields:
@@ -1,10 +1,72 @@
+import io
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import make_dataclass
 from datetime import datetime
-from io import StringIO
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Dict, Iterator, Set, get_args, get_type_hints
 import boto3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import logging
 import pg8000
+from fire_department.metrics import pipeline_metrics
+from fire_department.object_cache import S3ObjectCache
+from fire_department.repository.postgres.bronze import delete_object_bronze_sql_queries, \
+    delete_object_quarantine_sql_query, object_bronze_row_count_sql_query
+from fire_department.repository.postgres.control import ingestion_manifest_object_loaded_sql_query, \
+    ingestion_watermark_sql_query, insert_ingestion_manifest_sql_query, insert_pipeline_run_metrics_sql_query, \
+    next_batch_id_sql_query
+from fire_department.repository.postgres.gold import create_fact_partition_sql_query, fact_partition_bounds_sql_query
+
+
+class S3RangeFile(io.RawIOBase):
+    # Seekable read only view over an S3 object, every read is a ranged GET so parquet readers only fetch the
+    # footer and the column chunks they need
+    def __init__(self, s3_client: boto3.client, bucket_name: str, filename: str):
+        super().__init__()
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.filename = filename
+        self.size = s3_client.head_object(Bucket=bucket_name, Key=filename)['ContentLength']
+        self.position = 0
+        # Bytes actually downloaded by the ranged GETs
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        else:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.size or len(buffer) == 0:
+            return 0
+        last_byte = min(self.position + len(buffer), self.size) - 1
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.filename,
+                                             Range=f'bytes={self.position}-{last_byte}')
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.bytes_read += len(data)
+        return len(data)
 
 
 class Utils:
@@ -35,16 +97,32 @@ class Utils:
         return data
 
     @staticmethod
-    def list_files_in_s3(s3_client: boto3.client, bucket_name: str) -> List[Tuple[str, datetime]]:
-        # List files in the S3 bucket
-        response = s3_client.list_objects(Bucket=bucket_name)
-
-        # Extract file names and last modified timestamps
-        files = response.get('Contents', [])
-        files_info = [(file['Key'], file['LastModified']) for file in files]
+    def list_files_in_s3(s3_client: boto3.client, bucket_name: str,
+                         suffixes: Tuple[str, ...] = ('.csv', '.parquet'),
+                         prefix: str = '') -> List[Tuple[str, datetime]]:
+        with pipeline_metrics.stage('s3_list', bucket=bucket_name, prefix=prefix) as record:
+            # List files in the S3 bucket, a single call returns at most 1000 keys so every page is read
+            files_info = []
+            for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+                # Extract file names and last modified timestamps, only data files are considered
+                files_info.extend((file['Key'], file['LastModified']) for file in page.get('Contents', [])
+                                  if file['Key'].lower().endswith(suffixes))
+            record['rows'] = len(files_info)
 
         return files_info
 
+    @staticmethod
+    def read_manifest_from_s3(s3_client: boto3.client, bucket_name: str, manifest_file_name: str) -> Optional[dict]:
+        # The manifest written by the generator lists the data objects in the order they were written
+        with pipeline_metrics.stage('s3_manifest', key=manifest_file_name) as record:
+            try:
+                response = s3_client.get_object(Bucket=bucket_name, Key=manifest_file_name)
+            except s3_client.exceptions.NoSuchKey:
+                return None
+            body = response['Body'].read()
+            record['bytes'] = len(body)
+            return json.loads(body)
+
     @staticmethod
     def get_latest_file_name(files_info: List[Tuple[str, datetime]]) -> Optional[str]:
         # Check if there are any files
@@ -56,37 +134,499 @@ class Utils:
         return latest_file[0]
 
     @staticmethod
-    def get_file_from_s3_as_dataframe(s3_client: boto3.client, bucket_name: str, filename: str,
-                                      FireDepartmentModel) -> pd.DataFrame:
+    def get_s3_object_part_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+        # Inclusive byte ranges of the parts an object of size bytes is downloaded in
+        return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+    @staticmethod
+    def download_s3_object_parts(s3_client: boto3.client, bucket_name: str, filename: str, head: dict,
+                                 part_size: int, max_concurrency: int, write_part) -> None:
+        # Parts are fetched with concurrent ranged GETs and handed to write_part(offset, data) as they complete. Every
+        # GET is pinned to the ETag of head, an object overwritten during the download fails instead of mixing the
+        # parts of two versions
+        def download_part(part_range):
+            start, end = part_range
+            response = s3_client.get_object(Bucket=bucket_name, Key=filename, Range=f'bytes={start}-{end}',
+                                            IfMatch=head['ETag'])
+            data = response['Body'].read()
+            if len(data) != end - start + 1:
+                raise IOError(f"Short read of {filename} bytes {start}-{end}: {len(data)} bytes")
+            write_part(start, data)
+
+        part_ranges = Utils.get_s3_object_part_ranges(head['ContentLength'], part_size)
+        with ThreadPoolExecutor(max_workers=max(min(max_concurrency, len(part_ranges)), 1)) as executor:
+            # Consuming the results re-raises the error of a failed part
+            list(executor.map(download_part, part_ranges))
+
+    @staticmethod
+    def download_s3_object_to_buffer(s3_client: boto3.client, bucket_name: str, filename: str, part_size: int,
+                                     max_concurrency: int) -> bytearray:
+        # The buffer is allocated once with the object size, parts are copied at their offset
+        head = s3_client.head_object(Bucket=bucket_name, Key=filename)
+        buffer = bytearray(head['ContentLength'])
+        buffer_view = memoryview(buffer)
+
+        def write_part(offset, data):
+            buffer_view[offset:offset + len(data)] = data
+
+        Utils.download_s3_object_parts(s3_client, bucket_name, filename, head, part_size, max_concurrency, write_part)
+        return buffer
+
+    @staticmethod
+    def download_s3_object_to_file(s3_client: boto3.client, bucket_name: str, filename: str, file_object,
+                                   part_size: int, max_concurrency: int, etag: Optional[str] = None) -> int:
+        # The file is sized up front and parts are written at their offset, the file is left positioned at its start.
+        # With etag the download fails if the object no longer has that content
+        head = s3_client.head_object(Bucket=bucket_name, Key=filename,
+                                     **({'IfMatch': f'"{etag}"'} if etag else {}))
+        file_object.truncate(head['ContentLength'])
+        file_descriptor = file_object.fileno()
+
+        def write_part(offset, data):
+            data = memoryview(data)
+            while data:
+                written = os.pwrite(file_descriptor, data, offset)
+                data, offset = data[written:], offset + written
+
+        Utils.download_s3_object_parts(s3_client, bucket_name, filename, head, part_size, max_concurrency, write_part)
+        file_object.seek(0)
+        return head['ContentLength']
+
+    @staticmethod
+    def get_cached_s3_object_path(s3_client: boto3.client, bucket_name: str, filename: str, etag: str,
+                                  object_cache: S3ObjectCache, part_size: int, max_concurrency: int) -> Tuple[str, int]:
+        # Local copy of the object, downloaded into the cache on a miss. Returns its path and the bytes downloaded
+        cached_path = object_cache.lookup(bucket_name, filename, etag)
+        if cached_path is not None:
+            return cached_path, 0
+        with object_cache.writer(bucket_name, filename, etag) as cache_file:
+            downloaded_bytes = Utils.download_s3_object_to_file(s3_client, bucket_name, filename, cache_file,
+                                                                part_size, max_concurrency, etag)
+        return object_cache.get_path(bucket_name, filename, etag), downloaded_bytes
+
+    @staticmethod
+    def get_s3_object_stats(s3_client: boto3.client, bucket_name: str, filename: str) -> Dict[str, str]:
+        # Row count, key high-water marks and incident_date range the generator stores as user metadata of the objects
+        # it writes, empty for objects written without them
+        return s3_client.head_object(Bucket=bucket_name, Key=filename)['Metadata']
+
+    @staticmethod
+    def get_object_stats_max(object_stats: Dict[str, str], field: str) -> Optional[int]:
+        value = object_stats.get(f"max-{field}".replace('_', '-'))
+        return None if value is None else int(value)
+
+    @staticmethod
+    def get_s3_object_etag(s3_client: boto3.client, bucket_name: str, filename: str) -> str:
+        response = s3_client.head_object(Bucket=bucket_name, Key=filename)
+        return response['ETag'].strip('"')
+
+    @staticmethod
+    def is_object_ingested(postgres_connection, object_key: str, etag: str, stage: str = 'warehouse') -> bool:
+        cursor = postgres_connection.cursor()
         try:
-            # Read existing CSV file from S3
-            response = s3_client.get_object(Bucket=bucket_name, Key=filename)
-            csv_data = pd.read_csv(response['Body'])
+            cursor.execute(ingestion_manifest_object_loaded_sql_query, (object_key, etag, stage))
+            return cursor.fetchone()[0] > 0
+        finally:
+            cursor.close()
 
-            # Define a function to normalize column names
-            def normalize_column_name(column_name):
-                return column_name.lower().replace(' ', '_')
+    @staticmethod
+    def is_manifest_entry_ingested(postgres_connection, entry: dict, stage: str = 'warehouse') -> bool:
+        if Utils.is_object_ingested(postgres_connection, entry['key'], entry['etag'], stage):
+            return True
+        # A compacted object holds exactly the rows of the objects it replaces
+        replaced_entries = entry.get('replaces') or []
+        return bool(replaced_entries) and all(
+            Utils.is_manifest_entry_ingested(postgres_connection, replaced_entry, stage)
+            for replaced_entry in replaced_entries)
 
-            # Apply the function to normalize all column names
-            csv_data.columns = csv_data.columns.map(normalize_column_name)
+    @staticmethod
+    def get_ingestion_watermark(postgres_connection, stage: str = 'warehouse') -> Tuple[int, int]:
+        # Highest id and incident_number loaded into the stage by any previous run
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(ingestion_watermark_sql_query, (stage,))
+            max_id, max_incident_number = cursor.fetchone()
+            return int(max_id), int(max_incident_number)
+        finally:
+            cursor.close()
 
-            # Convert CSV data to FireDepartmentModel instances
-            data_instances = []
-            for _, row in csv_data.iterrows():
-                data_dict = row.to_dict()
-                data_instance = FireDepartmentModel(**data_dict)
-                data_instances.append(data_instance)
+    @staticmethod
+    def record_ingestion_watermark(postgres_connection, object_key: str, etag: str, max_id: int,
+                                   max_incident_number: int, rows_loaded: int, stage: str = 'warehouse') -> None:
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(insert_ingestion_manifest_sql_query,
+                           (object_key, etag, max_id, max_incident_number, rows_loaded, stage))
+            postgres_connection.commit()
+            logging.info(f"Ingestion watermark recorded for {object_key} ({stage}): id={max_id}, "
+                         f"incident_number={max_incident_number}, rows={rows_loaded}")
+        except Exception:
+            postgres_connection.rollback()
+            raise
+        finally:
+            cursor.close()
 
-            # Convert data instances to Pandas DataFrame
-            df = pd.DataFrame([data.__dict__ for data in data_instances])
+    @staticmethod
+    def delete_unrecorded_object_rows(postgres_connection, object_key: str, etag: str, stage: str,
+                                      delete_bronze: bool) -> None:
+        # The object is not in the ingestion manifest of the stage, rows committed for it by a run that failed before
+        # recording it are deleted so loading it again does not append them twice
+        cursor = postgres_connection.cursor()
+        try:
+            with pipeline_metrics.stage('delete_unrecorded_rows', object_key=object_key, ingestion_stage=stage) \
+                    as record:
+                queries = delete_object_bronze_sql_queries if delete_bronze else []
+                record['rows'] = 0
+                for query in queries:
+                    cursor.execute(query, (object_key, etag))
+                    record['rows'] += cursor.rowcount
+                cursor.execute(delete_object_quarantine_sql_query, (object_key, etag, stage))
+                record['rows'] += cursor.rowcount
+                postgres_connection.commit()
+            if record['rows']:
+                logging.warning(f"{record['rows']} rows left by an earlier run for {object_key} ({stage}) deleted")
+        except Exception:
+            postgres_connection.rollback()
+            raise
+        finally:
+            cursor.close()
 
-            return df
+    @staticmethod
+    def check_object_bronze_rows(postgres_connection, object_key: str, etag: str, rows_loaded: int) -> None:
+        # More rows than the run loaded means rows of an earlier attempt were kept. Raised before the object is
+        # recorded, so the next run loads it again instead of keeping the duplicates
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(object_bronze_row_count_sql_query, (object_key, etag))
+            bronze_rows = int(cursor.fetchone()[0])
+            postgres_connection.commit()
+        finally:
+            cursor.close()
+        if bronze_rows != rows_loaded:
+            logging.error(f"The bronze copy of {object_key} ({etag}) holds {bronze_rows} rows, {rows_loaded} were "
+                          f"loaded")
+            raise ValueError(f"Bronze rows of {object_key} do not match the rows loaded")
+
+    @staticmethod
+    def filter_rows_above_watermark(dataframe: pd.DataFrame, watermark_field: str, watermark: int) -> pd.DataFrame:
+        # Only rows that were never loaded go through the bronze, silver and gold stages
+        return dataframe[dataframe[watermark_field] > watermark]
+
+    @staticmethod
+    def get_column_max(dataframe: pd.DataFrame, field: str) -> int:
+        # 0 when the frame is empty or the column only holds nulls
+        max_value = dataframe[field].max(skipna=True)
+        return 0 if pd.isna(max_value) else int(max_value)
+
+    @staticmethod
+    def is_parquet_file(filename: str) -> bool:
+        return filename.lower().endswith('.parquet')
+
+    @staticmethod
+    def get_file_from_s3_as_dataframe(s3_client: boto3.client, bucket_name: str, filename: str,
+                                      FireDepartmentModel, watermark: Optional[Tuple[str, int]] = None,
+                                      categorical_fields: Optional[List[str]] = None,
+                                      categorical_max_unique_ratio: Optional[float] = None,
+                                      part_size: int = 8 * 1024 * 1024, max_concurrency: int = 8,
+                                      etag: Optional[str] = None,
+                                      object_cache: Optional[S3ObjectCache] = None
+                                      ) -> Tuple[pd.DataFrame, Dict[str, pd.Series], pd.DataFrame]:
+        try:
+            # S3 download and parsing
+            with pipeline_metrics.stage('s3_read', key=filename) as record:
+                # With an object cache the object is read from its local copy, downloaded on a miss
+                cached_path = None
+                if object_cache is not None and etag is not None:
+                    cached_path, record['bytes'] = Utils.get_cached_s3_object_path(
+                        s3_client, bucket_name, filename, etag, object_cache, part_size, max_concurrency)
+
+                if Utils.is_parquet_file(filename):
+                    # Read only the model columns and the row groups above the watermark, from the memory mapped
+                    # local copy or with ranged GETs
+                    if cached_path is None:
+                        range_file = S3RangeFile(s3_client, bucket_name, filename)
+                        parquet_file = pq.ParquetFile(range_file)
+                    else:
+                        parquet_file = pq.ParquetFile(cached_path, memory_map=True)
+                    table = parquet_file.read_row_groups(Utils.get_parquet_row_groups(parquet_file, watermark),
+                                                         columns=Utils.get_parquet_columns(parquet_file,
+                                                                                           FireDepartmentModel))
+                    table = Utils.dictionary_encode_arrow_columns(Utils.filter_parquet_table(table, watermark),
+                                                                  categorical_fields)
+                    raw_data = table.to_pandas()
+                    if cached_path is None:
+                        record['bytes'] = range_file.bytes_read
+                else:
+                    if cached_path is None:
+                        # CSV fallback, the whole object is downloaded in parallel parts and parsed from memory
+                        buffer = Utils.download_s3_object_to_buffer(s3_client, bucket_name, filename, part_size,
+                                                                    max_concurrency)
+                        csv_source = pa.BufferReader(buffer)
+                        record['bytes'] = len(buffer)
+                    else:
+                        csv_source = cached_path
+                    raw_data = pd.read_csv(csv_source, usecols=Utils.get_csv_column_filter(FireDepartmentModel))
+                record['rows'] = len(raw_data)
+
+            # Apply the function to normalize all column names
+            raw_data.columns = raw_data.columns.map(Utils.normalize_column_name)
+
+            # Cast whole columns to the types declared on the model, the rows that failed are returned by column.
+            # The frame as read is returned too, quarantined rows are recorded with the values that broke a rule
+            df, coercion_failures = Utils.coerce_dataframe_to_model(raw_data, FireDepartmentModel)
+            Utils.log_coercion_failures(filename, coercion_failures)
+
+            return Utils.encode_categorical_columns(df, FireDepartmentModel, categorical_fields,
+                                                    categorical_max_unique_ratio), coercion_failures, raw_data
 
         except Exception as e:
+            logging.error(f"Error reading file {filename} from s3: {e}")
+            raise  # Re-raise the exception
 
-            logging.error(f"Error: {e}")
+    @staticmethod
+    def get_file_from_s3_as_dataframe_chunks(s3_client: boto3.client, bucket_name: str, filename: str,
+                                             FireDepartmentModel, chunk_size: int,
+                                             watermark: Optional[Tuple[str, int]] = None,
+                                             categorical_fields: Optional[List[str]] = None,
+                                             categorical_max_unique_ratio: Optional[float] = None,
+                                             part_size: int = 8 * 1024 * 1024, max_concurrency: int = 8,
+                                             etag: Optional[str] = None,
+                                             object_cache: Optional[S3ObjectCache] = None
+                                             ) -> Iterator[Tuple[pd.DataFrame, Dict[str, pd.Series], pd.DataFrame]]:
+        # Stream the S3 body, only one chunk of rows is held in memory at a time
+        csv_file = None
+        # With an object cache the chunks are read from the local copy of the object, downloaded on a miss
+        cached_path = None
+        if object_cache is not None and etag is not None:
+            with pipeline_metrics.stage('s3_download', key=filename) as record:
+                cached_path, record['bytes'] = Utils.get_cached_s3_object_path(
+                    s3_client, bucket_name, filename, etag, object_cache, part_size, max_concurrency)
+
+        if Utils.is_parquet_file(filename):
+            if cached_path is None:
+                range_file = S3RangeFile(s3_client, bucket_name, filename)
+                parquet_file = pq.ParquetFile(range_file)
+                get_bytes_read = lambda: range_file.bytes_read
+            else:
+                parquet_file = pq.ParquetFile(cached_path, memory_map=True)
+                get_bytes_read = lambda: 0
+            batches = parquet_file.iter_batches(batch_size=chunk_size,
+                                                row_groups=Utils.get_parquet_row_groups(parquet_file, watermark),
+                                                columns=Utils.get_parquet_columns(parquet_file, FireDepartmentModel))
+            chunks = (Utils.dictionary_encode_arrow_columns(Utils.filter_parquet_table(batch, watermark),
+                                                            categorical_fields).to_pandas()
+                      for batch in batches)
+        else:
+            if cached_path is None:
+                # The object is downloaded in parallel parts to a temporary file the chunks are then parsed from, the
+                # file is removed when the chunks are exhausted or the reader is closed
+                csv_file = tempfile.TemporaryFile()
+                with pipeline_metrics.stage('s3_download', key=filename) as record:
+                    record['bytes'] = Utils.download_s3_object_to_file(s3_client, bucket_name, filename, csv_file,
+                                                                       part_size, max_concurrency)
+            chunks = pd.read_csv(csv_file if cached_path is None else cached_path, chunksize=chunk_size,
+                                 usecols=Utils.get_csv_column_filter(FireDepartmentModel))
+            # Bytes are accounted for by the download
+            get_bytes_read = lambda: 0
+
+        chunk_number = 0
+        bytes_before = 0
+        try:
+            while True:
+                # S3 download and parsing of the next chunk
+                with pipeline_metrics.stage('s3_read', key=filename, chunk=chunk_number) as record:
+                    raw_chunk = next(chunks, None)
+                    record['rows'] = 0 if raw_chunk is None else len(raw_chunk)
+                    record['bytes'] = get_bytes_read() - bytes_before
+                    bytes_before += record['bytes']
+                if raw_chunk is None:
+                    return
+
+                raw_chunk.columns = raw_chunk.columns.map(Utils.normalize_column_name)
+                df, coercion_failures = Utils.coerce_dataframe_to_model(raw_chunk, FireDepartmentModel)
+                Utils.log_coercion_failures(f'{filename} chunk {chunk_number}', coercion_failures)
+                yield Utils.encode_categorical_columns(df, FireDepartmentModel, categorical_fields,
+                                                       categorical_max_unique_ratio), coercion_failures, raw_chunk
+                chunk_number += 1
+        finally:
+            if csv_file is not None:
+                csv_file.close()
 
-        return pd.DataFrame()
+    @staticmethod
+    def get_parquet_columns(parquet_file: pq.ParquetFile, FireDepartmentModel) -> List[str]:
+        # Projection pushdown, only the columns declared on the model are decoded
+        model_columns = set(get_type_hints(FireDepartmentModel))
+        return [name for name in parquet_file.schema_arrow.names
+                if Utils.normalize_column_name(name) in model_columns]
+
+    @staticmethod
+    def get_csv_column_filter(FireDepartmentModel):
+        # Same projection for CSV, columns not declared on the model are skipped by the parser
+        model_columns = set(get_type_hints(FireDepartmentModel))
+        return lambda name: Utils.normalize_column_name(name) in model_columns
+
+    @staticmethod
+    def get_projected_model(model, columns: List[str], model_name: str):
+        # Dataclass with only the given columns of the model, in the model order, readers project on it
+        type_hints = get_type_hints(model)
+        return make_dataclass(model_name, [(column, type_hints[column]) for column in type_hints if column in columns])
+
+    @staticmethod
+    def get_parquet_row_groups(parquet_file: pq.ParquetFile, watermark: Optional[Tuple[str, int]]) -> List[int]:
+        # Predicate pushdown, row groups whose max value is not above the watermark are skipped
+        row_groups = list(range(parquet_file.metadata.num_row_groups))
+        if watermark is None:
+            return row_groups
+        field, minimum = watermark
+        column_index = parquet_file.schema_arrow.get_field_index(field)
+        if column_index < 0:
+            return row_groups
+
+        selected_row_groups = []
+        for row_group in row_groups:
+            statistics = parquet_file.metadata.row_group(row_group).column(column_index).statistics
+            if statistics is None or not statistics.has_min_max or statistics.max > minimum:
+                selected_row_groups.append(row_group)
+        return selected_row_groups
+
+    @staticmethod
+    def filter_parquet_table(table, watermark: Optional[Tuple[str, int]]):
+        # Row level filter for the row groups that straddle the watermark, rows without the field are kept for the
+        # data quality rules
+        if watermark is None or watermark[0] not in table.schema.names:
+            return table
+        field, minimum = watermark
+        return table.filter(pc.or_kleene(pc.greater(table[field], minimum), pc.is_null(table[field])))
+
+    @staticmethod
+    def dictionary_encode_arrow_columns(table, categorical_fields: Optional[List[str]]):
+        # Declared string columns are dictionary encoded while still in arrow, pandas gets them as categoricals and
+        # never builds a python string per row
+        if not categorical_fields:
+            return table
+        arrays = [pc.dictionary_encode(column)
+                  if Utils.normalize_column_name(name) in categorical_fields
+                  and (pa.types.is_string(column.type) or pa.types.is_large_string(column.type))
+                  else column
+                  for name, column in zip(table.schema.names, table.columns)]
+        return type(table).from_arrays(arrays, names=table.schema.names)
+
+    @staticmethod
+    def encode_categorical_columns(dataframe: pd.DataFrame, model, categorical_fields: Optional[List[str]],
+                                   max_unique_ratio: Optional[float]) -> pd.DataFrame:
+        # Text columns of the model that are declared, or detected as low cardinality, are held as categoricals
+        if categorical_fields is None:
+            return dataframe
+        with pipeline_metrics.stage('categorical_encoding') as record:
+            record['rows'] = len(dataframe)
+            encoded_columns = {}
+            for column, column_type in Utils.get_model_column_types(model).items():
+                series = dataframe[column]
+                if column_type is not str or isinstance(series.dtype, pd.CategoricalDtype):
+                    continue
+                if column in categorical_fields or \
+                        (max_unique_ratio is not None and series.nunique() <= max_unique_ratio * len(series)):
+                    encoded_columns[column] = series.astype('category')
+            return dataframe.assign(**encoded_columns) if encoded_columns else dataframe
+
+    @staticmethod
+    def get_dataframe_memory_usage(dataframe: pd.DataFrame) -> Tuple[int, int]:
+        # Bytes held by the frame, and the bytes it would hold with its categoricals decoded. Decoding is only paid
+        # when the report is requested
+        usage = dataframe.memory_usage(deep=True, index=False)
+        memory_bytes = int(usage.sum())
+        decoded_memory_bytes = memory_bytes
+        for position in range(dataframe.shape[1]):
+            series = dataframe.iloc[:, position]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                decoded = series.astype(series.cat.categories.dtype)
+                decoded_memory_bytes += int(decoded.memory_usage(deep=True, index=False)) - int(usage.iloc[position])
+        return memory_bytes, decoded_memory_bytes
+
+    @staticmethod
+    def log_memory_report(stage: str, dataframes: Dict[str, pd.DataFrame]) -> Dict[str, Dict[str, int]]:
+        memory_report = {}
+        for name, dataframe in dataframes.items():
+            memory_bytes, decoded_memory_bytes = Utils.get_dataframe_memory_usage(dataframe)
+            memory_report[name] = {'bytes': memory_bytes, 'decoded_bytes': decoded_memory_bytes}
+        total_bytes = sum(report['bytes'] for report in memory_report.values())
+        total_decoded_bytes = sum(report['decoded_bytes'] for report in memory_report.values())
+        logging.info(f"Memory at {stage}: {total_bytes / 1024 / 1024:.2f} MB, "
+                     f"{total_decoded_bytes / 1024 / 1024:.2f} MB without categoricals - "
+                     + ', '.join(f"{name} {report['bytes'] / 1024 / 1024:.2f} MB"
+                                 for name, report in memory_report.items()))
+        return memory_report
+
+    @staticmethod
+    def normalize_column_name(column_name: str) -> str:
+        return column_name.lower().replace(' ', '_')
+
+    @staticmethod
+    def get_model_column_types(model) -> Dict[str, type]:
+        # Unwrap Optional[...] annotations so every column maps to its base python type
+        column_types = {}
+        for column, annotation in get_type_hints(model).items():
+            type_args = [arg for arg in get_args(annotation) if arg is not type(None)]
+            column_types[column] = type_args[0] if type_args else annotation
+        return column_types
+
+    @staticmethod
+    def coerce_series(series: pd.Series, column_type: type) -> pd.Series:
+        if column_type is int:
+            numbers = pd.to_numeric(series, errors='coerce')
+            # Fractional values can not be represented as integers, they are treated as coercion failures
+            return numbers.where(numbers % 1 == 0).astype('Int64')
+        if column_type is float:
+            return pd.to_numeric(series, errors='coerce').astype('float64')
+        if column_type is datetime:
+            if pd.api.types.is_datetime64_any_dtype(series):
+                return series
+            timestamps = pd.to_datetime(series, errors='coerce')
+            # The inferred format is applied to the whole column, values in any other format are parsed on a
+            # second pass restricted to the rows that failed
+            retry = timestamps.isna() & series.notna()
+            if retry.any():
+                timestamps[retry] = pd.to_datetime(series[retry], errors='coerce', format='mixed')
+            return timestamps
+        if column_type is str:
+            if pd.api.types.is_float_dtype(series) and (series.dropna() % 1 == 0).all():
+                # Codes like zipcode are parsed as floats when the column has nulls, drop the trailing '.0'
+                series = series.astype('Int64')
+            if pd.api.types.is_numeric_dtype(series):
+                return series.astype(object).where(series.isna(), series.astype(str))
+            return series
+        return series
+
+    @staticmethod
+    def coerce_dataframe_to_model(dataframe: pd.DataFrame, model) -> Tuple[pd.DataFrame, Dict[str, pd.Series]]:
+        column_types = Utils.get_model_column_types(model)
+
+        missing_columns = set(column_types) - set(dataframe.columns)
+        if missing_columns:
+            raise ValueError(f"Missing columns in DataFrame: {missing_columns}")
+
+        coerced_columns = {}
+        coercion_failures = {}
+        with pipeline_metrics.stage('coerce') as record:
+            record['rows'] = len(dataframe)
+            for column, column_type in column_types.items():
+                series = dataframe[column]
+                coerced = Utils.coerce_series(series, column_type)
+                # A value fails coercion when it was present in the source and is null after the cast. The mask of the
+                # failed rows is kept for the data quality rules
+                failed = coerced.isna() & series.notna()
+                if failed.any():
+                    coercion_failures[column] = failed
+                coerced_columns[column] = coerced
+
+        # Columns are returned in the order they are declared on the model
+        return pd.DataFrame(coerced_columns, index=dataframe.index), coercion_failures
+
+    @staticmethod
+    def log_coercion_failures(filename: str, coercion_failures: Dict[str, pd.Series]) -> None:
+        for column, failed in coercion_failures.items():
+            logging.warning(f"{filename}: {int(failed.sum())} value(s) in column '{column}' could not be coerced "
+                            f"to the model type and were set to null")
 
     @staticmethod
     def clean_str(x):
@@ -102,32 +642,113 @@ class Utils:
             return text
 
     @staticmethod
-    def df_execute_bulk_db_load(df, table_name, engine):  # postgres_connection ):
-        # cursor = postgres_connection.cursor()
+    def is_text_series(series: pd.Series) -> bool:
+        return pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)
 
-        postgres_connection = engine.raw_connection()
-        cursor = postgres_connection.cursor()
-        try:
-            # Create an empty buffer to store the csv data
-            buffer = StringIO()
-            # Write the dataframe to the buffer without the index column
-            df.to_csv(buffer, index=False)
-            # Reset the buffer position to the beginning
-            buffer.seek(0)
+    @staticmethod
+    def transform_distinct_strings(series: pd.Series, kernel, scalar_function) -> pd.Series:
+        # The string kernel runs once per distinct value and the results are mapped back through the factorize codes,
+        # dimension like columns only hold a handful of values. Nulls and non string values are kept as they are
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Only the categories are transformed, categories that end up equal are merged and the codes remapped
+            categories = series.cat.categories
+            if not len(categories):
+                return series
+            transformed_categories = Utils.transform_distinct_strings(
+                pd.Series(categories.to_numpy(dtype=object), dtype=object), kernel, scalar_function)
+            category_codes, new_categories = pd.factorize(transformed_categories)
+            codes = series.cat.codes.to_numpy()
+            new_codes = np.where(codes >= 0, category_codes.take(codes, mode='clip'), -1)
+            return pd.Series(pd.Categorical.from_codes(new_codes, categories=new_categories),
+                             index=series.index, name=series.name)
+        if not Utils.is_text_series(series):
+            return series
+        codes, uniques = pd.factorize(series)
+        uniques = pd.Series(uniques, dtype=object)
+        if pd.api.types.infer_dtype(uniques, skipna=True) in ('string', 'empty'):
+            transformed_uniques = kernel(uniques.astype(object).str).to_numpy(dtype=object)
+        else:
+            # Mixed values, only the strings are transformed
+            transformed_uniques = uniques.map(scalar_function).to_numpy(dtype=object)
+        transformed = transformed_uniques.take(codes, mode='clip') if len(transformed_uniques) else \
+            np.empty(len(series), dtype=object)
+        null_positions = np.flatnonzero(codes < 0)
+        if len(null_positions):
+            transformed[null_positions] = series.iloc[null_positions].to_numpy(dtype=object)
+        # Same dtype the per cell version ends up with
+        if pd.api.types.is_object_dtype(series):
+            return pd.Series(transformed, index=series.index, name=series.name, dtype=object).infer_objects()
+        return pd.Series(transformed, index=series.index, name=series.name, dtype=series.dtype)
+
+    @staticmethod
+    def clean_str_series(series: pd.Series) -> pd.Series:
+        # Vectorized Utils.clean_str
+        return Utils.transform_distinct_strings(series, lambda strings: strings.upper().str.strip(), Utils.clean_str)
 
-            # Copy the data from the buffer to the database table using the csv format and header option.
-            # Table must exist. Will overwrite that table.
-            cursor.execute(f'COPY {table_name} FROM STDIN WITH (FORMAT csv, HEADER);', stream=buffer)
+    @staticmethod
+    def first_letter_acronym_series(series: pd.Series) -> pd.Series:
+        # Vectorized Utils.first_letter_acronym, every space separated word longer than two characters is reduced
+        # to its first character and the spaces are dropped
+        return Utils.transform_distinct_strings(
+            series, lambda strings: strings.replace(r'([^ ])[^ ]{2,}', r'\1', regex=True).str.replace(' ', '', regex=False),
+            Utils.first_letter_acronym)
 
-            # Commit the changes to the database
-            postgres_connection.commit()
-            buffer.close()
+    @staticmethod
+    def clean_str_columns(dataframe: pd.DataFrame) -> pd.DataFrame:
+        # Vectorized DataFrame.map(Utils.clean_str), only text and categorical columns are touched
+        return dataframe.assign(**{column: Utils.clean_str_series(dataframe[column])
+                                   for column in dataframe.columns
+                                   if Utils.is_text_series(dataframe[column])
+                                   or isinstance(dataframe[column].dtype, pd.CategoricalDtype)})
+
+    @staticmethod
+    def iter_dataframe_as_csv(df: pd.DataFrame, rows_per_block: int = 50000) -> Iterator[bytes]:
+        # Serialize the dataframe in blocks of rows so the full csv text is never held in memory
+        for start in range(0, max(len(df), 1), rows_per_block):
+            block = df.iloc[start:start + rows_per_block]
+            yield block.to_csv(index=False, header=start == 0).encode('utf-8')
 
-            logging.info(f"The following table was loaded successfully: {table_name}")
+    @staticmethod
+    def df_execute_bulk_db_load(df, table_name, postgres_connection) -> Dict[str, float]:
+        cursor = postgres_connection.cursor()
+        bytes_sent = 0
+
+        def counted_blocks():
+            nonlocal bytes_sent
+            for block in Utils.iter_dataframe_as_csv(df):
+                bytes_sent += len(block)
+                yield block
+
+        try:
+            start_time = time.perf_counter()
+
+            with pipeline_metrics.stage('copy', table=table_name) as record:
+                # Stream the csv blocks to the database table using the csv format and header option.
+                # Table must exist. Rows are appended to that table.
+                cursor.execute(f'COPY {table_name} FROM STDIN WITH (FORMAT csv, HEADER);', stream=counted_blocks())
+
+                # Commit the changes to the database
+                postgres_connection.commit()
+                record['rows'] = len(df)
+                record['bytes'] = bytes_sent
+            elapsed_seconds = max(time.perf_counter() - start_time, 1e-9)
+
+            load_stats = {
+                'rows': len(df),
+                'bytes': bytes_sent,
+                'seconds': elapsed_seconds,
+                'rows_per_second': len(df) / elapsed_seconds,
+                'mb_per_second': bytes_sent / 1024 / 1024 / elapsed_seconds,
+            }
+            logging.info(f"The following table was loaded successfully: {table_name} - {load_stats['rows']} rows, "
+                         f"{load_stats['bytes'] / 1024 / 1024:.2f} MB in {elapsed_seconds:.2f}s "
+                         f"({load_stats['rows_per_second']:.0f} rows/s, {load_stats['mb_per_second']:.2f} MB/s)")
+            return load_stats
 
         except Exception as e:
             postgres_connection.rollback()
-            logging.info(f"Error loading table: {table_name}\nError: {e}")
+            logging.error(f"Error loading table: {table_name}\nError: {e}")
+            raise  # Re-raise the exception
         finally:
             cursor.close()
 
@@ -138,26 +759,217 @@ class Utils:
         try:
             for query in queries:
                 try:
-                    cursor.execute(query)
-                    postgres_connection.commit()
+                    with pipeline_metrics.stage('execute_query', query=' '.join(query.split())[:80]):
+                        cursor.execute(query)
+                        postgres_connection.commit()
                     logging.info(f"Query executed and committed successfully: {query}")
 
                 except Exception as e:
                     postgres_connection.rollback()
-                    logging.info(f"Error executing query: {query}\nError: {e}")
+                    logging.error(f"Error executing query: {query}\nError: {e}")
+                    raise  # Re-raise the exception
 
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def get_next_batch_id(postgres_connection) -> int:
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(next_batch_id_sql_query)
+            batch_id = int(cursor.fetchone()[0])
+            postgres_connection.commit()
+            return batch_id
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def write_pipeline_metrics(postgres_connection, metrics_rows: List[tuple]) -> None:
+        cursor = postgres_connection.cursor()
+        try:
+            for metrics_row in metrics_rows:
+                cursor.execute(insert_pipeline_run_metrics_sql_query, metrics_row)
+            postgres_connection.commit()
+            logging.info(f"{len(metrics_rows)} stage metrics written to pipeline_run_metrics")
         except Exception as e:
-            print(f"Error: {e}")
+            postgres_connection.rollback()
+            logging.error(f"Error writing the pipeline run metrics\nError: {e}")
+            raise  # Re-raise the exception
+        finally:
+            cursor.close()
 
+    @staticmethod
+    def execute_gold_merges(postgres_connection, merges, batch_id: int) -> Dict[str, Dict[str, int]]:
+        # Each merge only reads the staging rows of batch_id, its counts are committed together with it
+        cursor = postgres_connection.cursor()
+        merge_report = {}
+        try:
+            for table_name, stats_query, merge_query in merges:
+                try:
+                    with pipeline_metrics.stage('gold_merge', table=table_name, batch_id=batch_id) as record:
+                        cursor.execute(stats_query, (batch_id,))
+                        staged, conflicting = cursor.fetchone()
+                        cursor.execute(merge_query, (batch_id,))
+                        # Merges built on a data modifying CTE return their inserted, and optionally updated, row
+                        # counts
+                        merged_counts = cursor.fetchone() if cursor.description else (max(cursor.rowcount, 0),)
+                        inserted = merged_counts[0]
+                        postgres_connection.commit()
+                        record['rows'] = inserted
+                except Exception as e:
+                    postgres_connection.rollback()
+                    logging.error(f"Error merging batch {batch_id} into {table_name}\nError: {e}")
+                    raise  # Re-raise the exception
+
+                merge_report[table_name] = {
+                    'staged': staged,
+                    'inserted': inserted,
+                    'conflicting': conflicting,
+                    # Rows that were neither inserted nor in conflict with the target, e.g. repeated in the batch
+                    'skipped': max(staged - inserted - conflicting, 0),
+                }
+                if len(merged_counts) > 1:
+                    # Conflicting rows whose attributes changed and were written
+                    merge_report[table_name]['updated'] = merged_counts[1]
+                logging.info(f"Batch {batch_id} merged into {table_name}: {merge_report[table_name]}")
         finally:
             cursor.close()
 
+        return merge_report
+
     @staticmethod
     def create_dataframe_without_duplicates(fields_to_distinct, dataframe):
         # Create a list of column expressions
         distinct_result = dataframe[fields_to_distinct].drop_duplicates(ignore_index=True)
         return distinct_result
 
+    @staticmethod
+    def create_missing_fact_partitions(postgres_connection, batch_id: int, granularity: str) -> List[str]:
+        # Creates the incident_date range partitions the staged rows of batch_id fall into, existing ones are kept
+        if granularity not in ('month', 'year'):
+            raise ValueError(f"Unsupported fact partition granularity: {granularity}")
+        name_format = '%Y_%m' if granularity == 'month' else '%Y'
+
+        cursor = postgres_connection.cursor()
+        partition_names = []
+        try:
+            with pipeline_metrics.stage('create_partitions', batch_id=batch_id) as record:
+                cursor.execute(fact_partition_bounds_sql_query, (granularity, granularity, granularity, batch_id))
+                for range_start, range_end in cursor.fetchall():
+                    partition_name = f"fact_fire_department_injuries_p{range_start.strftime(name_format)}"
+                    cursor.execute(create_fact_partition_sql_query.format(partition_name=partition_name,
+                                                                          range_start=range_start.isoformat(' '),
+                                                                          range_end=range_end.isoformat(' ')))
+                    partition_names.append(partition_name)
+                postgres_connection.commit()
+                record['rows'] = len(partition_names)
+        except Exception as e:
+            postgres_connection.rollback()
+            logging.error(f"Error creating the fact partitions of batch {batch_id}\nError: {e}")
+            raise  # Re-raise the exception
+        finally:
+            cursor.close()
+
+        if partition_names:
+            logging.info(f"{len(partition_names)} fact partitions ready for batch {batch_id}, "
+                         f"from {partition_names[0]} to {partition_names[-1]}")
+        return partition_names
+
+    @staticmethod
+    def get_query_plan(postgres_connection, query) -> dict:
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}")
+            plan = cursor.fetchone()[0]
+            # pg8000 may hand the json plan back as text
+            return (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def iter_plan_nodes(plan: dict) -> Iterator[dict]:
+        yield plan
+        for child_plan in plan.get('Plans', []):
+            yield from Utils.iter_plan_nodes(child_plan)
+
+    @staticmethod
+    def check_query_plan(plan: dict, expected_nodes: Optional[Tuple[str, ...]],
+                         max_fact_partitions: Optional[int]) -> List[str]:
+        # Returns the regressions found in the plan, an empty list means the plan is the expected one
+        nodes = list(Utils.iter_plan_nodes(plan))
+        problems = []
+
+        node_types = {node['Node Type'] for node in nodes}
+        if expected_nodes and not node_types.intersection(expected_nodes):
+            problems.append(f"none of {list(expected_nodes)} in the plan, found {sorted(node_types)}")
+
+        fact_partitions = {node['Relation Name'] for node in nodes
+                           if node.get('Relation Name', '').startswith('fact_fire_department_injuries')}
+        if max_fact_partitions is not None and len(fact_partitions) > max_fact_partitions:
+            problems.append(f"{len(fact_partitions)} fact partitions scanned, expected at most {max_fact_partitions}")
+
+        for node in nodes:
+            for condition in ('Hash Cond', 'Merge Cond', 'Join Filter', 'Index Cond', 'Recheck Cond'):
+                if '::date' in node.get(condition, ''):
+                    problems.append(f"{node['Node Type']} casts to date: {node[condition]}")
+        return problems
+
+    @staticmethod
+    def get_dimension_surrogate_keys(postgres_connection, keys_query) -> Dict[str, int]:
+        # Natural key to surrogate key map of a dimension, dimensions are small enough to be held in memory
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(keys_query)
+            return {natural_key: int(surrogate_key) for natural_key, surrogate_key in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def ensure_unknown_dimension_member(postgres_connection, unknown_member_query, unknown_sk: int):
+        cursor = postgres_connection.cursor()
+        try:
+            cursor.execute(unknown_member_query, (unknown_sk,))
+            postgres_connection.commit()
+        except Exception as e:
+            postgres_connection.rollback()
+            logging.error(f"Error creating the unknown dimension member {unknown_sk}\nError: {e}")
+            raise  # Re-raise the exception
+        finally:
+            cursor.close()
+
+    @staticmethod
+    def has_unresolved_keys(series: pd.Series, key_map: Dict[str, int]) -> bool:
+        # True when a non null natural key has no surrogate key yet
+        return not series.dropna().isin(key_map.keys()).all()
+
+    @staticmethod
+    def map_surrogate_keys(series: pd.Series, key_map: Dict[str, int], unknown_sk: int) -> pd.Series:
+        # Vectorized lookup, missing and unknown natural keys fall back to the unknown member
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Categoricals are resolved once per category and the keys taken through the codes
+            codes = series.cat.codes.to_numpy()
+            if not len(series.cat.categories):
+                return pd.Series(np.full(len(series), unknown_sk, dtype='int64'), index=series.index,
+                                 name=series.name)
+            category_keys = pd.Series(series.cat.categories).map(key_map).fillna(unknown_sk).astype('int64')
+            return pd.Series(np.where(codes >= 0, category_keys.to_numpy().take(codes, mode='clip'), unknown_sk),
+                             index=series.index, name=series.name)
+        return series.map(key_map).fillna(unknown_sk).astype('int64')
+
+    @staticmethod
+    def add_row_hash(dataframe: pd.DataFrame, fields: List[str]) -> pd.DataFrame:
+        # Stable 64 bit hash of the given columns of every row, stored as a signed bigint
+        row_hash = pd.util.hash_pandas_object(dataframe[fields], index=False).to_numpy().view('int64')
+        return dataframe.assign(row_hash=row_hash)
+
+    @staticmethod
+    def drop_seen_rows(dataframe: pd.DataFrame, fields: List[str], seen_keys: Set[tuple]) -> pd.DataFrame:
+        # Dedup across chunks, rows whose key was already emitted by a previous chunk are dropped
+        keys = pd.MultiIndex.from_frame(dataframe[fields])
+        is_new = ~keys.isin(list(seen_keys))
+        seen_keys.update(keys[is_new])
+        return dataframe[is_new].reset_index(drop=True)
+
     @staticmethod
     def validate_dataframe(dataframe, model):
         # Check if the DataFrame has the expected columns
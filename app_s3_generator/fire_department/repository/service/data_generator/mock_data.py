@@ -1,180 +1,157 @@
+from datetime import date, datetime, time, timedelta
 from faker import Faker
-from shapely.geometry import Point
-from shapely.wkt import dumps as wkt_dumps
-import random
-from typing import NamedTuple
+import numpy as np
+import polars as pl
+from typing import NamedTuple, Optional
 
+from fire_department.repository.model.fire_department_model import fire_department_schema
 
-fake = Faker()
-def generate_sample_payload_enhanced(num_new_rows: int, max_values: NamedTuple) -> dict:
-    # Use the retrieved max values for generating new sample payload
+
+# Value domains of the mocked columns
+BATTALIONS = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B09', 'B10')
+FIRST_UNITS_ON_SCENE = ('E01', 'E02', 'T01', 'B01', 'MED01')
+PRIMARY_SITUATIONS = ('412 - Gas leak (natural gas or LPG)',
+                      '552 - Police matter',
+                      '210 - Steam Rupture, steam, other',
+                      '522 - Water or steam leak',
+                      '520 - Water problem, other',
+                      '733 - Smoke detector activation/malfunction',
+                      '711 - Municipal alarm system, Street Box False')
+ACTION_TAKEN_PRIMARY_SCENARIOS = ('86 - Investigate',
+                                  '71 - Extinguish',
+                                  '45 - Rescue, remove from harm',
+                                  '32 - Provide first aid & check for injuries',
+                                  '22 - Search & rescue, other',
+                                  '94 - Disregard',
+                                  '12 - Fire control or extinguishment, other',
+                                  '58 - Assist physically disabled',
+                                  '67 - Victim impaled on object',
+                                  '39 - Extricate victim(s) from stalled elevator')
+PROPERTY_USES = ('962 - Residential street, road or residential dr',
+                 '960 - Street, other',
+                 '429 - Multifamily dwellings',
+                 '400 - Residential, other')
+NEIGHBORHOOD_DISTRICTS = ('Financial District/South Beach', 'Outer Richmond', 'Hayes Valley', 'South of Market',
+                          'Potrero Hill', 'Bernal Heights', 'Inner Sunset')
+# Columns that are constant in every mocked row
+CONSTANT_VALUES = {
+    'city': 'SF',
+    'number_of_alarms': 1,
+    'mutual_aid': 'None',
+    'action_taken_secondary': '-',
+    'action_taken_other': '-',
+    'detector_alerted_occupants': '-',
+    'area_of_fire_origin': '-',
+    'ignition_cause': '-',
+    'ignition_factor_primary': '-',
+    'ignition_factor_secondary': '-',
+    'heat_source': '-',
+    'item_first_ignited': '-',
+    'human_factors_associated_with_ignition': '-',
+    'structure_type': '-',
+    'structure_status': '-',
+    'floor_of_fire_origin': '-',
+    'fire_spread': '-',
+    'no_flame_spead': '-',
+    'number_of_floors_with_minimum_damage': 0,
+    'number_of_floors_with_significant_damage': 0,
+    'number_of_floors_with_heavy_damage': 0,
+    'number_of_floors_with_extreme_damage': 0,
+    'detectors_present': '-',
+    'detector_type': '-',
+    'detector_operation': '-',
+    'detector_effectiveness': '-',
+    'detector_failure_reason': '-',
+    'automatic_extinguishing_system_present': '-',
+    'automatic_extinguishing_sytem_type': '-',
+    'automatic_extinguishing_sytem_perfomance': '-',
+    'automatic_extinguishing_sytem_failure_reason': '-',
+    'number_of_sprinkler_heads_operating': 0,
+}
+# Size of the pools of Faker values sampled by the columnar generator
+FAKER_POOL_SIZE = 1000
+
+
+def allocate_keys(max_value: int, num_new_rows: int, rng: np.random.Generator, shuffle: bool = True) -> np.ndarray:
+    # Hands out the range right above the current max value, every key is used exactly once so no row has to be
+    # discarded afterwards. Shuffling keeps the keys unordered, as the randomly drawn ones were
+    keys = np.arange(max_value + 1, max_value + 1 + num_new_rows, dtype=np.int64)
+    return rng.permutation(keys) if shuffle else keys
+
+
+def generate_mocked_data_columnar(num_new_rows: int, max_values: NamedTuple, seed: Optional[int] = None,
+                                  end_datetime: Optional[datetime] = None, shuffle_keys: bool = True
+                                  ) -> pl.DataFrame:
+    # Every column is drawn as a whole array from a seeded generator, so the same seed and end_datetime always produce
+    # the same frame. end_datetime defaults to the start of today, callers wanting reproducible rows pass it
+    rng = np.random.default_rng(seed)
     max_incident_number, max_id_value, max_call_number = max_values
 
-    incident_number = fake.random_int(max_incident_number + 1, max_incident_number + num_new_rows)
-    exposure_number = fake.random_int(0, 1)
-    id_value = fake.random_int(max_id_value + 1, max_id_value + num_new_rows)
-    address = fake.street_address()
-    incident_date = (
-            fake.date_time_this_decade() + fake.time_delta()).isoformat()  # fake.date_this_decade().isoformat()
-    call_number = fake.random_int(max_call_number + 1, max_call_number + num_new_rows)
-    alarm_datetime = fake.date_time_this_decade().isoformat()
-    arrival_datetime = (fake.date_time_this_decade() + fake.time_delta()).isoformat()
-    close_datetime = (fake.date_time_this_decade() + fake.time_delta()).isoformat()
-    city = 'SF'
-    zipcode = fake.zipcode()
-    battalion = fake.random_element(elements=('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B09', 'B10'))
-    station_area = fake.word()
-    box = fake.word()
-    suppression_units = fake.random_int(1, 10)
-    suppression_personnel = fake.random_int(1, 50)
-    ems_units = fake.random_int(0, 5)
-    ems_personnel = fake.random_int(0, 20)
-    other_units = fake.random_int(0, 5)
-    other_personnel = fake.random_int(0, 20)
-    first_unit_on_scene = fake.random_element(elements=('E01', 'E02', 'T01', 'B01', 'MED01'))
-    estimated_property_loss = random.uniform(0, 50000)
-    estimated_contents_loss = random.uniform(0, 50000)
-    fire_fatalities = fake.random_int(0, 2)
-    fire_injuries = fake.random_int(0, 5)
-    civilian_fatalities = fake.random_int(0, 2)
-    civilian_injuries = fake.random_int(0, 5)
-    num_alarms = 1
-    primary_situation = fake.random_element(elements=('412 - Gas leak (natural gas or LPG)',
-                                                      '552 - Police matter',
-                                                      '210 - Steam Rupture, steam, other',
-                                                      '522 - Water or steam leak',
-                                                      '520 - Water problem, other',
-                                                      '733 - Smoke detector activation/malfunction',
-                                                      '711 - Municipal alarm system, Street Box False'))
-    mutual_aid = 'None'
-    action_taken_primary_scenarios = [
-        '86 - Investigate',
-        '71 - Extinguish',
-        '45 - Rescue, remove from harm',
-        '32 - Provide first aid & check for injuries',
-        '22 - Search & rescue, other',
-        '94 - Disregard',
-        '12 - Fire control or extinguishment, other',
-        '58 - Assist physically disabled',
-        '67 - Victim impaled on object',
-        '39 - Extricate victim(s) from stalled elevator',
-    ]
-    action_taken_primary = fake.random_element(elements=action_taken_primary_scenarios)
-    action_taken_secondary = '-'
-    action_taken_other = '-'
-    detector_alerted_occupants = '-'
-    property_use = fake.random_element(elements=('962 - Residential street, road or residential dr',
-                                                 '960 - Street, other',
-                                                 '429 - Multifamily dwellings',
-                                                 '400 - Residential, other'))
-    area_of_fire_origin = '-'
-    ignition_cause = '-'
-    ignition_factor_primary = '-'
-    ignition_factor_secondary = '-'
-    heat_source = '-'
-    item_first_ignited = '-'
-    human_factors_associated_with_ignition = '-'
-    structure_type = '-'
-    structure_status = '-'
-    floor_of_fire_origin = '-'
-    fire_spread = '-'
-    no_flame_spread = '-'
-    num_floors_with_min_damage = 0
-    num_floors_with_significant_damage = 0
-    num_floors_with_heavy_damage = 0
-    num_floors_with_extreme_damage = 0
-    detectors_present = '-'
-    detector_type = '-'
-    detector_operation = '-'
-    detector_effectiveness = '-'
-    detector_failure_reason = '-'
-    automatic_extinguishing_system_present = '-'
-    automatic_extinguishing_system_type = '-'
-    automatic_extinguishing_system_performance = '-'
-    automatic_extinguishing_system_failure_reason = '-'
-    num_sprinkler_heads_operating = 0
-    supervisor_district = fake.random_int(1, 11)
-    neighborhood_district = fake.random_element(elements=('Financial District/South Beach', 'Outer Richmond',
-                                                          'Hayes Valley', 'South of Market', 'Potrero Hill',
-                                                          'Bernal Heights', 'Inner Sunset'))
-    point = generate_random_point()  # wkt_dumps(Point(fake.longitude(), fake.latitude()))
+    # Faker is only used to build small pools of values which are then sampled
+    faker = Faker()
+    faker.seed_instance(seed)
+    addresses = [faker.street_address() for _ in range(FAKER_POOL_SIZE)]
+    zipcodes = [faker.zipcode() for _ in range(FAKER_POOL_SIZE)]
+    words = faker.words(nb=FAKER_POOL_SIZE)
 
-    return {
-        "incident_number": incident_number,
-        "exposure_number": exposure_number,
-        "id": id_value,
-        "address": address,
-        "incident_date": incident_date,
-        "call_number": call_number,
-        "alarm_dttm": alarm_datetime,
-        "arrival_dttm": arrival_datetime,
-        "close_dttm": close_datetime,
-        "city": city,
-        "zipcode": zipcode,
-        "battalion": battalion,
-        "station_area": station_area,
-        "box": box,
-        "suppression_units": suppression_units,
-        "suppression_personnel": suppression_personnel,
-        "ems_units": ems_units,
-        "ems_personnel": ems_personnel,
-        "other_units": other_units,
-        "other_personnel": other_personnel,
-        "first_unit_on_scene": first_unit_on_scene,
-        "estimated_property_loss": estimated_property_loss,
-        "estimated_contents_loss": estimated_contents_loss,
-        "fire_fatalities": fire_fatalities,
-        "fire_injuries": fire_injuries,
-        "civilian_fatalities": civilian_fatalities,
-        "civilian_injuries": civilian_injuries,
-        "number_of_alarms": num_alarms,
-        "primary_situation": primary_situation,
-        "mutual_aid": mutual_aid,
-        "action_taken_primary": action_taken_primary,
-        "action_taken_secondary": action_taken_secondary,
-        "action_taken_other": action_taken_other,
-        "detector_alerted_occupants": detector_alerted_occupants,
-        "property_use": property_use,
-        "area_of_fire_origin": area_of_fire_origin,
-        "ignition_cause": ignition_cause,
-        "ignition_factor_primary": ignition_factor_primary,
-        "ignition_factor_secondary": ignition_factor_secondary,
-        "heat_source": heat_source,
-        "item_first_ignited": item_first_ignited,
-        "human_factors_associated_with_ignition": human_factors_associated_with_ignition,
-        "structure_type": structure_type,
-        "structure_status": structure_status,
-        "floor_of_fire_origin": floor_of_fire_origin,
-        "fire_spread": fire_spread,
-        "no_flame_spead": no_flame_spread,
-        "number_of_floors_with_minimum_damage": num_floors_with_min_damage,
-        "number_of_floors_with_significant_damage": num_floors_with_significant_damage,
-        "number_of_floors_with_heavy_damage": num_floors_with_heavy_damage,
-        "number_of_floors_with_extreme_damage": num_floors_with_extreme_damage,
-        "detectors_present": detectors_present,
-        "detector_type": detector_type,
-        "detector_operation": detector_operation,
-        "detector_effectiveness": detector_effectiveness,
-        "detector_failure_reason": detector_failure_reason,
-        "automatic_extinguishing_system_present": automatic_extinguishing_system_present,
-        "automatic_extinguishing_sytem_type": automatic_extinguishing_system_type,
-        "automatic_extinguishing_sytem_perfomance": automatic_extinguishing_system_performance,
-        "automatic_extinguishing_sytem_failure_reason": automatic_extinguishing_system_failure_reason,
-        "number_of_sprinkler_heads_operating": num_sprinkler_heads_operating,
-        "supervisor_district": supervisor_district,
-        "neighborhood_district": neighborhood_district,
-        "point": point
-    }
+    def sample(elements) -> np.ndarray:
+        return np.asarray(elements, dtype=object)[rng.integers(0, len(elements), num_new_rows)]
+
+    def integers(low: int, high: int) -> np.ndarray:
+        # Both ends included, as in fake.random_int
+        return rng.integers(low, high + 1, num_new_rows)
 
+    # Timestamps within this decade, as in fake.date_time_this_decade, drawn as microseconds since the epoch
+    end_datetime = end_datetime or datetime.combine(date.today(), time())
+    decade_start = datetime(end_datetime.year - end_datetime.year % 10, 1, 1)
+    decade_start_microseconds = (decade_start - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    end_microseconds = (end_datetime - datetime(1970, 1, 1)) // timedelta(microseconds=1)
 
-def generate_random_point() -> str:
-    # Generate random coordinates within a specific bounding box
-    min_longitude, max_longitude = -180, 180
-    min_latitude, max_latitude = -90, 90
+    def timestamps() -> pl.Series:
+        return pl.Series(rng.integers(decade_start_microseconds, end_microseconds, num_new_rows)).cast(
+            pl.Datetime('us'))
+
+    columns = {
+        'incident_number': allocate_keys(max_incident_number, num_new_rows, rng, shuffle_keys),
+        'exposure_number': integers(0, 1),
+        'id': allocate_keys(max_id_value, num_new_rows, rng, shuffle_keys),
+        'address': sample(addresses),
+        'incident_date': timestamps(),
+        'call_number': allocate_keys(max_call_number, num_new_rows, rng, shuffle_keys),
+        'alarm_dttm': timestamps(),
+        'arrival_dttm': timestamps(),
+        'close_dttm': timestamps(),
+        'zipcode': sample(zipcodes),
+        'battalion': sample(BATTALIONS),
+        'station_area': sample(words),
+        'box': sample(words),
+        'suppression_units': integers(1, 10),
+        'suppression_personnel': integers(1, 50),
+        'ems_units': integers(0, 5),
+        'ems_personnel': integers(0, 20),
+        'other_units': integers(0, 5),
+        'other_personnel': integers(0, 20),
+        'first_unit_on_scene': sample(FIRST_UNITS_ON_SCENE),
+        'estimated_property_loss': rng.uniform(0, 50000, num_new_rows),
+        'estimated_contents_loss': rng.uniform(0, 50000, num_new_rows),
+        'fire_fatalities': integers(0, 2),
+        'fire_injuries': integers(0, 5),
+        'civilian_fatalities': integers(0, 2),
+        'civilian_injuries': integers(0, 5),
+        'primary_situation': sample(PRIMARY_SITUATIONS),
+        'action_taken_primary': sample(ACTION_TAKEN_PRIMARY_SCENARIOS),
+        'property_use': sample(PROPERTY_USES),
+        'supervisor_district': integers(1, 11),
+        'neighborhood_district': sample(NEIGHBORHOOD_DISTRICTS),
+        'longitude': rng.uniform(-180, 180, num_new_rows),
+        'latitude': rng.uniform(-90, 90, num_new_rows),
+    }
 
-    longitude = random.uniform(min_longitude, max_longitude)
-    latitude = random.uniform(min_latitude, max_latitude)
+    df = (pl.DataFrame(columns)
+          .with_columns([pl.lit(value).alias(name) for name, value in CONSTANT_VALUES.items()])
+          # WKT points anywhere on the globe
+          .with_columns(pl.format('POINT ({} {})', pl.col('longitude'), pl.col('latitude')).alias('point'))
+          .select(list(fire_department_schema))
+          .cast(fire_department_schema))
 
-    # Create a Shapely Point object and convert it to WKT format
-    point = Point(longitude, latitude)
-    return wkt_dumps(point)
+    return df
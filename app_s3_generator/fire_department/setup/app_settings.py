@@ -3,7 +3,19 @@ class AppSettings:
         "bucket_name",
         "region_name",
         "local_stack_endpoint",
-        "fields_to_check_duplicates"
+        "fields_to_check_duplicates",
+        "file_format",
+        "output_mode",
+        "delta_prefix",
+        "manifest_file_name",
+        "compaction_target_size",
+        "compaction_retention_seconds",
+        "shuffle_keys",
+        "seeded_end_date",
+        "s3_download_part_size",
+        "s3_download_concurrency",
+        "s3_cache_dir",
+        "s3_cache_max_bytes"
     ]
 
     def __init__(
@@ -13,3 +25,25 @@ class AppSettings:
         self.region_name = "us-east-1"
         self.local_stack_endpoint = "http://localhost:4566"
         self.fields_to_check_duplicates = ['incident_number', 'id', 'call_number']
+        # Format of the files written to s3, 'parquet' or 'csv'
+        self.file_format = "parquet"
+        # 'append' uploads only the new rows as a delta object, 'full' rewrites the whole history
+        self.output_mode = "append"
+        self.delta_prefix = "deltas/"
+        self.manifest_file_name = "manifest/manifest.json"
+        # Delta objects smaller than this many bytes are merged by the compact command
+        self.compaction_target_size = 128 * 1024 * 1024
+        # Objects replaced by a compaction are deleted by the first compaction run after this many seconds, main jobs
+        # that read the manifest before the compaction can still download them
+        self.compaction_retention_seconds = 24 * 60 * 60
+        # New keys are allocated as the range above the current max values, shuffled or in sequential order
+        self.shuffle_keys = True
+        # Latest timestamp of the rows of a seeded run without --end-date, the same seed gives the same rows any day
+        self.seeded_end_date = "2024-01-01"
+        # Objects read back from S3 are downloaded with concurrent ranged GETs of this many bytes, by this many threads
+        self.s3_download_part_size = 8 * 1024 * 1024
+        self.s3_download_concurrency = 8
+        # Local copies of the S3 objects, keyed by bucket, key and ETag and shared with the main job. Uploaded objects
+        # are seeded into it. Least recently used copies are evicted above s3_cache_max_bytes. None disables the cache
+        self.s3_cache_dir = "~/.cache/fire-department/s3"
+        self.s3_cache_max_bytes = 2 * 1024 * 1024 * 1024
@@ -1,21 +1,29 @@
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from io import BytesIO
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 import polars as pl
+import pyarrow.parquet as pq
 
 import boto3
+from botocore.exceptions import ClientError
+
+from fire_department.object_cache import S3ObjectCache
 
 
 class Utils:
     @staticmethod
-    def list_files_in_s3(s3_client: boto3.client, bucket_name: str) -> List[Tuple[str, datetime]]:
-        # List files in the S3 bucket
-        response = s3_client.list_objects(Bucket=bucket_name)
-
-        # Extract file names and last modified timestamps
-        files = response.get('Contents', [])
-        files_info = [(file['Key'], file['LastModified']) for file in files]
+    def list_files_in_s3(s3_client: boto3.client, bucket_name: str,
+                         suffixes: Tuple[str, ...] = ('.csv', '.parquet'),
+                         prefix: str = '') -> List[Tuple[str, datetime]]:
+        # List files in the S3 bucket, a single call returns at most 1000 keys so every page is read
+        files_info = []
+        for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket_name, Prefix=prefix):
+            # Extract file names and last modified timestamps, only data files are considered
+            files_info.extend((file['Key'], file['LastModified']) for file in page.get('Contents', [])
+                              if file['Key'].lower().endswith(suffixes))
 
         return files_info
 
@@ -29,32 +37,145 @@ class Utils:
         latest_file = max(files_info, key=lambda x: x[1])
         return latest_file[0]
 
+    @staticmethod
+    def get_latest_file_name_from_manifest(manifest: Optional[dict]) -> Optional[str]:
+        # The manifest lists the objects in the order they were written, the last one is the latest without listing
+        # the bucket
+        if not manifest or not manifest['objects']:
+            return None
+        return manifest['objects'][-1]['key']
+
+    @staticmethod
+    def get_s3_object_part_ranges(size: int, part_size: int) -> List[Tuple[int, int]]:
+        # Inclusive byte ranges of the parts an object of size bytes is downloaded in
+        return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+    @staticmethod
+    def download_s3_object_to_buffer(s3_client: boto3.client, bucket_name: str, filename: str, part_size: int,
+                                     max_concurrency: int, etag: Optional[str] = None) -> bytearray:
+        # The buffer is allocated once with the object size and the parts, fetched with concurrent ranged GETs, are
+        # copied at their offset. Every GET is pinned to the ETag read up front, an object overwritten during the
+        # download fails instead of mixing the parts of two versions. With etag the download also fails if the
+        # object no longer has that content
+        head = s3_client.head_object(Bucket=bucket_name, Key=filename,
+                                     **({'IfMatch': f'"{etag}"'} if etag else {}))
+        buffer = bytearray(head['ContentLength'])
+        buffer_view = memoryview(buffer)
+
+        def download_part(part_range):
+            start, end = part_range
+            response = s3_client.get_object(Bucket=bucket_name, Key=filename, Range=f'bytes={start}-{end}',
+                                            IfMatch=head['ETag'])
+            data = response['Body'].read()
+            if len(data) != end - start + 1:
+                raise IOError(f"Short read of {filename} bytes {start}-{end}: {len(data)} bytes")
+            buffer_view[start:end + 1] = data
+
+        part_ranges = Utils.get_s3_object_part_ranges(head['ContentLength'], part_size)
+        with ThreadPoolExecutor(max_workers=max(min(max_concurrency, len(part_ranges)), 1)) as executor:
+            # Consuming the results re-raises the error of a failed part
+            list(executor.map(download_part, part_ranges))
+        return buffer
+
+    @staticmethod
+    def get_cached_s3_object_path(s3_client: boto3.client, bucket_name: str, filename: str, etag: str,
+                                  object_cache: S3ObjectCache, part_size: int, max_concurrency: int) -> str:
+        # Local copy of the object, downloaded into the cache on a miss
+        cached_path = object_cache.lookup(bucket_name, filename, etag)
+        if cached_path is not None:
+            return cached_path
+        with object_cache.writer(bucket_name, filename, etag) as cache_file:
+            cache_file.write(Utils.download_s3_object_to_buffer(s3_client, bucket_name, filename, part_size,
+                                                                max_concurrency, etag))
+        return object_cache.get_path(bucket_name, filename, etag)
+
     @staticmethod
     def get_file_from_s3_as_dataframe(s3_client: boto3.client, bucket_name: str, filename: str,
-                                      schema: dict) -> pl.DataFrame:
-        # Read existing CSV file from S3 if available
+                                      schema: dict, part_size: int = 8 * 1024 * 1024,
+                                      max_concurrency: int = 8, etag: Optional[str] = None,
+                                      object_cache: Optional[S3ObjectCache] = None) -> pl.DataFrame:
+        # Read existing CSV or Parquet file from S3 if available
         if filename:
-            response = s3_client.get_object(Bucket=bucket_name, Key=filename)
-            data_dataframe = pl.read_csv(response['Body'], dtypes=schema)
+            if object_cache is not None and etag is not None:
+                # Local copy, Parquet files are memory mapped
+                data = Utils.get_cached_s3_object_path(s3_client, bucket_name, filename, etag, object_cache,
+                                                       part_size, max_concurrency)
+            else:
+                data = BytesIO(Utils.download_s3_object_to_buffer(s3_client, bucket_name, filename, part_size,
+                                                                  max_concurrency))
+            if Utils.is_parquet_file(filename):
+                data_dataframe = pl.read_parquet(data).select(list(schema)).cast(schema)
+            else:
+                data_dataframe = pl.read_csv(data, dtypes=schema)
             return data_dataframe
         else:
             # If no existing file, create an empty DataFrame
             data_dataframe = pl.DataFrame(schema=schema)
             return data_dataframe
 
+    @staticmethod
+    def is_parquet_file(filename: str) -> bool:
+        return filename.lower().endswith('.parquet')
+
     @staticmethod
     def check_and_log_error(dataframe: pl.DataFrame):
         error_message = "Repeated values found in one of the main fields."
 
         if dataframe.shape[0] > 0:
-            logging.INFO(dataframe)
+            logging.info(dataframe)
             logging.error(f"Error: {error_message}")
             raise ValueError(error_message)
 
+    @staticmethod
+    def get_object_stats_key(prefix: str, field: str) -> str:
+        # S3 user metadata keys are lower case, hyphens are used since underscores are dropped by some proxies
+        return f"{prefix}-{field}".replace('_', '-')
+
+    @staticmethod
+    def get_dataframe_stats(dataframe: pl.DataFrame, key_fields: List[str],
+                            date_field: str = 'incident_date') -> Dict[str, str]:
+        # Row count, high-water marks of key_fields and range of date_field, stored as user metadata of the object
+        # so the next run gets its key baseline without downloading it
+        stats = {'row-count': str(dataframe.height)}
+        for field in key_fields:
+            max_value = dataframe[field].max()
+            if max_value is not None:
+                stats[Utils.get_object_stats_key('max', field)] = str(max_value)
+        for prefix, date_value in (('min', dataframe[date_field].min()), ('max', dataframe[date_field].max())):
+            if date_value is not None:
+                stats[Utils.get_object_stats_key(prefix, date_field)] = date_value.isoformat()
+        return stats
+
+    @staticmethod
+    def get_s3_object_stats(s3_client: boto3.client, bucket_name: str, filename: str) -> Dict[str, str]:
+        # User metadata of the object, empty for objects written before stats were recorded
+        return s3_client.head_object(Bucket=bucket_name, Key=filename)['Metadata']
+
+    @staticmethod
+    def put_object_to_s3(s3_client: boto3.client, bucket_name: str, key: str, body: bytes,
+                         object_cache: Optional[S3ObjectCache] = None,
+                         stats: Optional[Dict[str, str]] = None) -> Tuple[str, int]:
+        # Data objects are never overwritten, a key that already exists fails the conditional put instead of replacing
+        # rows a reader may have listed under its previous ETag
+        try:
+            response = s3_client.put_object(Bucket=bucket_name, Key=key, Body=body, Metadata=stats or {},
+                                            IfNoneMatch='*')
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'PreconditionFailed':
+                logging.error(f"{key} already exists on s3, it is not overwritten")
+                raise FileExistsError(key) from e
+            raise
+        etag = response['ETag'].strip('"')
+        if object_cache is not None:
+            # Seeds the cache so the main job reads the object it is about to ingest from local disk
+            object_cache.put_bytes(bucket_name, key, etag, body)
+        return etag, len(body)
+
     @staticmethod
     def send_csv_to_s3(
-            s3_client: boto3.client, bucket_name: str, new_latest_file_name: str, combined_dataframe: pl.DataFrame
-    ) -> None:
+            s3_client: boto3.client, bucket_name: str, new_latest_file_name: str, combined_dataframe: pl.DataFrame,
+            object_cache: Optional[S3ObjectCache] = None, stats: Optional[Dict[str, str]] = None
+    ) -> Tuple[str, int]:
         # Write the combined DataFrame back to S3
         buffer = BytesIO()
         combined_dataframe.write_csv(buffer)
@@ -62,4 +183,62 @@ class Utils:
         # Seek to the beginning of the buffer before sending to S3
         buffer.seek(0)
 
-        s3_client.put_object(Bucket=bucket_name, Key=new_latest_file_name, Body=buffer.read())
+        body = buffer.read()
+        return Utils.put_object_to_s3(s3_client, bucket_name, new_latest_file_name, body, object_cache, stats)
+
+    @staticmethod
+    def send_parquet_to_s3(
+            s3_client: boto3.client, bucket_name: str, new_latest_file_name: str, combined_dataframe: pl.DataFrame,
+            partition_field: str = 'incident_date', object_cache: Optional[S3ObjectCache] = None,
+            stats: Optional[Dict[str, str]] = None
+    ) -> Tuple[str, int]:
+        # One row group per month of partition_field, readers prune row groups on their min/max statistics
+        partitions = (combined_dataframe
+                      .sort(partition_field, nulls_last=True)
+                      .with_columns(pl.col(partition_field).dt.truncate('1mo').alias('_partition'))
+                      .partition_by('_partition', maintain_order=True, include_key=False)
+                      if combined_dataframe.height else [combined_dataframe])
+
+        buffer = BytesIO()
+        with pq.ParquetWriter(buffer, combined_dataframe.to_arrow().schema) as writer:
+            for partition in partitions:
+                writer.write_table(partition.to_arrow())
+
+        # Seek to the beginning of the buffer before sending to S3
+        buffer.seek(0)
+
+        body = buffer.read()
+        return Utils.put_object_to_s3(s3_client, bucket_name, new_latest_file_name, body, object_cache, stats)
+
+    @staticmethod
+    def send_dataframe_to_s3(
+            s3_client: boto3.client, bucket_name: str, new_latest_file_name: str, dataframe: pl.DataFrame,
+            object_cache: Optional[S3ObjectCache] = None, stats_fields: Optional[List[str]] = None
+    ) -> Tuple[str, int]:
+        # The stats of the dataframe are stored as user metadata of the object when stats_fields are given
+        stats = Utils.get_dataframe_stats(dataframe, stats_fields) if stats_fields else None
+        # The file format is taken from the extension of the object key
+        if Utils.is_parquet_file(new_latest_file_name):
+            return Utils.send_parquet_to_s3(s3_client, bucket_name, new_latest_file_name, dataframe,
+                                            object_cache=object_cache, stats=stats)
+        return Utils.send_csv_to_s3(s3_client, bucket_name, new_latest_file_name, dataframe, object_cache, stats)
+
+    @staticmethod
+    def get_s3_object_etag(s3_client: boto3.client, bucket_name: str, filename: str) -> str:
+        response = s3_client.head_object(Bucket=bucket_name, Key=filename)
+        return response['ETag'].strip('"')
+
+    @staticmethod
+    def read_manifest_from_s3(s3_client: boto3.client, bucket_name: str, manifest_file_name: str) -> Optional[dict]:
+        # The manifest lists the data objects of the bucket in the order they were written
+        try:
+            response = s3_client.get_object(Bucket=bucket_name, Key=manifest_file_name)
+        except s3_client.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read())
+
+    @staticmethod
+    def send_manifest_to_s3(s3_client: boto3.client, bucket_name: str, manifest_file_name: str,
+                            manifest: dict) -> None:
+        s3_client.put_object(Bucket=bucket_name, Key=manifest_file_name,
+                             Body=json.dumps(manifest, indent=2).encode('utf-8'))
@@ -1,14 +1,22 @@
+import argparse
+import multiprocessing
+import os
 import sys
+import tempfile
+import uuid
 import boto3
 import logging
+import numpy as np
 import polars as pl
-from datetime import datetime
-from typing import List, NamedTuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple
 
+from fire_department.object_cache import S3ObjectCache
 from fire_department.setup.app_settings import AppSettings
 from fire_department.utils import Utils
 from fire_department.repository.model.fire_department_model import fire_department_schema
-from fire_department.repository.service.data_generator.mock_data import generate_sample_payload_enhanced
+from fire_department.repository.service.data_generator.mock_data import generate_mocked_data_columnar
 
 # Configure logging to send messages to CloudWatch Logs
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +27,12 @@ def get_app_settings():
     return AppSettings()
 
 
+def get_object_cache(app_settings: AppSettings) -> Optional[S3ObjectCache]:
+    if not app_settings.s3_cache_dir:
+        return None
+    return S3ObjectCache(app_settings.s3_cache_dir, app_settings.s3_cache_max_bytes)
+
+
 def get_max_values_from_csv(data_dataframe: pl.DataFrame, fields: List[str]) -> NamedTuple:
     # Create a named tuple dynamically based on the field names
     MaxValues: NamedTuple = NamedTuple('MaxValues', [(field, int) for field in fields])
@@ -36,54 +50,51 @@ def get_max_values_from_csv(data_dataframe: pl.DataFrame, fields: List[str]) ->
     return max_values_tuple
 
 
-def generate_mocked_data_as_dataframe(num_new_rows: int, max_values: NamedTuple) -> pl.DataFrame:
-    # Create a list of dictionaries using list comprehension with mocked data
-    mocked_data = [generate_sample_payload_enhanced(num_new_rows, max_values) for _ in range(num_new_rows)]
-
-    # # Load the list of dictionaries into a Polars DataFrame
-    df = pl.DataFrame(mocked_data)
-    df = (df
-          .with_columns(pl.col('incident_date').cast(pl.Datetime)
-                        , pl.col('alarm_dttm').cast(pl.Datetime)
-                        , pl.col('arrival_dttm').cast(pl.Datetime)
-                        , pl.col('close_dttm').cast(pl.Datetime))
-          )  # For DateTime
-
-    return df
-
+def get_max_values_from_stats(object_stats: dict, fields: List[str]) -> Optional[NamedTuple]:
+    # Key baseline from the user metadata of the object, None when any high-water mark is missing
+    stats_keys = {field: Utils.get_object_stats_key('max', field) for field in fields}
+    if any(stats_key not in object_stats for stats_key in stats_keys.values()):
+        return None
+    MaxValues: NamedTuple = NamedTuple('MaxValues', [(field, int) for field in fields])
+    return MaxValues(**{field: int(object_stats[stats_key]) for field, stats_key in stats_keys.items()})
 
-def remove_duplicates_from_dataframe(dataframe: pl.DataFrame, fields: List[str]) -> pl.DataFrame:
-    # List to store conditions for each field
-    conditions = []
 
-    for field in fields:
-        # Count occurrences of each value in the field and create a new DataFrame
-        value_counts = (dataframe
-                        .group_by(field)
-                        .agg(pl.count().alias(f'{field}_count'))
-                        )
+def generate_mocked_data_as_dataframe(num_new_rows: int, max_values: NamedTuple, seed: Optional[int] = None,
+                                      shuffle_keys: bool = True,
+                                      end_datetime: Optional[datetime] = None) -> pl.DataFrame:
+    # Whole columns are drawn at once and typed according to fire_department_schema
+    return generate_mocked_data_columnar(num_new_rows, max_values, seed, end_datetime, shuffle_keys)
 
-        # Filter values that have count greater than 1 (repeated)
-        repeated_values = (value_counts
-                           .filter(pl.col(f'{field}_count') > 1)
-                           .select(field, f'{field}_count')
-                           )
 
-        # Create a condition for the field where the value is in the set of repeated values
-        condition = ~dataframe[field].is_in(repeated_values[field])
+def generate_mocked_data_shard(shard: Tuple[int, int, tuple, int, bool, Optional[datetime], str]) -> str:
+    # Runs in a worker process, the shard is written to its own part file
+    shard_number, num_new_rows, max_values, seed, shuffle_keys, end_datetime, output_directory = shard
+    part_file_name = os.path.join(output_directory, f'part-{shard_number:05d}.parquet')
+    generate_mocked_data_as_dataframe(num_new_rows, max_values, seed, shuffle_keys,
+                                      end_datetime).write_parquet(part_file_name)
+    return part_file_name
 
-        # Append the condition to the list
-        conditions.append(condition)
 
-    # Combine conditions using logical AND
-    final_condition = conditions[0]
-    for condition in conditions[1:]:
-        final_condition = final_condition & condition
+def generate_mocked_data_sharded(num_new_rows: int, max_values: NamedTuple, seed: Optional[int], shuffle_keys: bool,
+                                 workers: int, output_directory: str,
+                                 end_datetime: Optional[datetime] = None) -> List[str]:
+    # Every shard gets a disjoint key range above max_values and its own seed derived from the run seed
+    shard_sizes = [num_new_rows // workers + (1 if shard_number < num_new_rows % workers else 0)
+                   for shard_number in range(workers)]
+    shard_seeds = [int(seed_sequence.generate_state(1)[0])
+                   for seed_sequence in np.random.SeedSequence(seed).spawn(workers)]
 
-    # Apply the combined condition to the original DataFrame
-    dataframe_cleaned = dataframe.filter(final_condition)
+    shards = []
+    key_offset = 0
+    for shard_number, (shard_size, shard_seed) in enumerate(zip(shard_sizes, shard_seeds)):
+        shard_max_values = tuple(max_value + key_offset for max_value in max_values)
+        shards.append((shard_number, shard_size, shard_max_values, shard_seed, shuffle_keys, end_datetime,
+                       output_directory))
+        key_offset += shard_size
 
-    return dataframe_cleaned
+    # Spawned processes do not inherit the thread pools of the parent polars runtime
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(generate_mocked_data_shard, shards))
 
 
 def find_repeated_values_by_field(dataframe: pl.DataFrame, fields: List[str]) -> pl.DataFrame:
@@ -117,69 +128,286 @@ def find_repeated_values_by_field(dataframe: pl.DataFrame, fields: List[str]) ->
     return repeated_values_df
 
 
-def get_new_latest_file_name(latest_file_name: Optional[str]) -> str:
-    # Add the timestamp suffix to the existing filename (if it exists) ensuring it ends with ".csv" or create a new
-    # one if no existing file
-    # Generate a timestamp for the filename suffix
-    timestamp_suffix = datetime.now().strftime("%Y%m%d_%H%M%S")
+def validate_unique_keys(dataframe: pl.DataFrame, fields: List[str]) -> None:
+    # Keys are allocated without collisions, the repeated values report is only built if this cheap check fails
+    if all(dataframe[field].n_unique() == dataframe.height for field in fields):
+        return
+    Utils.check_and_log_error(find_repeated_values_by_field(dataframe, fields))
+
 
-    # Remove everything after the second underscore and concatenate timestamp_suffix
+def get_new_latest_file_name(latest_file_name: Optional[str], file_format: str = 'csv') -> str:
+    # Add the timestamp suffix to the existing filename (if it exists) ensuring it ends with the file format
+    # extension or create a new one if no existing file
+    # Generate a timestamp for the filename suffix. Keys sort in write order, the microseconds and a random part keep
+    # the keys of runs started in the same second apart
+    timestamp_suffix = f'{datetime.now().strftime("%Y%m%d_%H%M%S_%f")}_{uuid.uuid4().hex[:8]}'
+
+    # Remove the key prefix and everything after the second underscore and concatenate timestamp_suffix
     if latest_file_name:
-        base_filename, extension = latest_file_name.split('_', 2)[:2]
-        filename = f'{base_filename}_{extension}_{timestamp_suffix}.csv'
+        base_filename, extension = latest_file_name.rsplit('/', 1)[-1].split('_', 2)[:2]
+        filename = f'{base_filename}_{extension}_{timestamp_suffix}.{file_format}'
     else:
-        filename = f'combined_data_{timestamp_suffix}.csv'
+        filename = f'combined_data_{timestamp_suffix}.{file_format}'
 
     return filename
 
 
-def main() -> None:
-    num_new_rows = 10000  # This number includes duplicates, these are removed on a following step - To be improved
+def get_manifest_entry(key: str, etag: str, size: int, rows: int, kind: str, **extra) -> dict:
+    return {
+        'key': key,
+        'etag': etag,
+        'size': size,
+        'rows': rows,
+        'kind': kind,
+        'created_at': datetime.now().isoformat(),
+        **extra,
+    }
+
+
+def check_new_keys(manifest: dict, keys: List[str]) -> None:
+    # A key listed by the manifest is never written again, its entry and ETag would no longer match the object
+    listed_keys = {entry['key'] for entry in manifest['objects']}
+    repeated_keys = [key for key in keys if key in listed_keys]
+    if repeated_keys:
+        logging.error(f"Keys already listed by the manifest: {repeated_keys}")
+        raise FileExistsError(f"Keys already listed by the manifest: {repeated_keys}")
+
+
+def get_or_create_manifest(s3_client: boto3.client, bucket_name: str, manifest: Optional[dict],
+                           latest_file_name: str) -> dict:
+    if manifest is None:
+        # First run with a manifest, the existing latest file becomes the base of the history
+        latest_file_head = s3_client.head_object(Bucket=bucket_name, Key=latest_file_name)
+        manifest = {'objects': [get_manifest_entry(latest_file_name, latest_file_head['ETag'].strip('"'),
+                                                   latest_file_head['ContentLength'], None, 'base')]}
+    return manifest
+
+
+def get_history_entries(manifest: dict) -> List[dict]:
+    # The whole history is the last base or full object plus every delta written after it
+    last_full_position = max(position for position, entry in enumerate(manifest['objects'])
+                             if entry['kind'] in ('base', 'full'))
+    return manifest['objects'][last_full_position:]
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description='Fire Department mock data generator')
+    parser.add_argument('command', nargs='?', choices=['generate', 'compact'], default='generate',
+                        help="'generate' uploads a new batch of mocked rows, 'compact' merges small delta objects")
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='Number of mocked rows to generate')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the mocked data random generator, the same seed and end date produce the '
+                             'same rows')
+    parser.add_argument('--end-date', default=None,
+                        help='Latest timestamp of the mocked rows (YYYY-MM-DD), they fall within its decade. Defaults '
+                             'to today, or to seeded_end_date of the app settings when --seed is given')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes the rows are generated by, each one writes its own part file')
+    parser.add_argument('--multi-object', action='store_true',
+                        help='In append mode, upload every part file as its own delta object instead of combining '
+                             'them into one upload')
+    parser.add_argument('--mode', choices=['append', 'full'], default=None,
+                        help="'append' uploads only the new rows as a delta object, 'full' uploads the whole "
+                             "history plus the new rows")
+    return parser.parse_args(args)
+
+
+def get_end_datetime(end_date: Optional[str], seed: Optional[int], app_settings: AppSettings) -> Optional[datetime]:
+    # A seeded run is pinned to a fixed window, otherwise its timestamps would move with the day it runs on
+    if end_date:
+        return datetime.fromisoformat(end_date)
+    if seed is not None:
+        return datetime.fromisoformat(app_settings.seeded_end_date)
+    return None
+
+
+def generate(app_settings: AppSettings, s3_client: boto3.client, mode: str, num_new_rows: int,
+             seed: Optional[int], workers: int = 1, multi_object: bool = False,
+             object_cache: Optional[S3ObjectCache] = None, end_datetime: Optional[datetime] = None) -> None:
 
-    app_settings = get_app_settings()
     bucket_name = app_settings.bucket_name
-
     fields_to_check_duplicates = app_settings.fields_to_check_duplicates
-    s3_client = boto3.client('s3', region_name=app_settings.region_name, endpoint_url=app_settings.local_stack_endpoint)
 
-    # List files in the S3 bucket
-    file_names_info = Utils.list_files_in_s3(s3_client, bucket_name)
-
-    # Get the file with the maximum last modified timestamp
-    latest_file_name = Utils.get_latest_file_name(file_names_info)
+    # The latest file is the last object of the manifest. Without one, every page of the bucket listing is read and
+    # the file with the maximum last modified timestamp is taken
+    manifest = Utils.read_manifest_from_s3(s3_client, bucket_name, app_settings.manifest_file_name)
+    latest_file_name = Utils.get_latest_file_name_from_manifest(manifest) or \
+        Utils.get_latest_file_name(Utils.list_files_in_s3(s3_client, bucket_name))
     if latest_file_name is None:
         logging.warning('No file found on s3')
         sys.exit()
 
-    # Retrieve the file from s3 in a polars data frame
-    latest_s3_file_dataframe = Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name, latest_file_name,
-                                                                   fire_department_schema)
-    # Get the max values from the CSV file in s3 according to fields_to_check_duplicates
-    max_values = get_max_values_from_csv(latest_s3_file_dataframe, fields_to_check_duplicates)
-
-    # Generate mocked dataframe with new values
-    # try passing a schema definition
-    mocked_data_dataframe = generate_mocked_data_as_dataframe(num_new_rows, max_values)
-
-    # Clean generated mocked dataframe
-    mocked_data_dataframe_cleaned = remove_duplicates_from_dataframe(mocked_data_dataframe, fields_to_check_duplicates)
+    manifest = get_or_create_manifest(s3_client, bucket_name, manifest, latest_file_name)
+
+    # In append mode the key baseline is the high-water marks of the last object of the manifest, its keys are above
+    # every key of the previous objects. They are read from its metadata, the object is only downloaded and scanned
+    # when they are missing. In full mode the whole history is read, it is uploaded again with the new rows
+    if mode == 'append':
+        latest_entry = manifest['objects'][-1]
+        max_values = get_max_values_from_stats(Utils.get_s3_object_stats(s3_client, bucket_name, latest_entry['key']),
+                                               fields_to_check_duplicates)
+        if max_values is None:
+            logger.info(f"No key high-water marks on {latest_entry['key']}, scanning it")
+            latest_s3_file_dataframe = Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name,
+                                                                           latest_entry['key'],
+                                                                           fire_department_schema,
+                                                                           app_settings.s3_download_part_size,
+                                                                           app_settings.s3_download_concurrency,
+                                                                           latest_entry['etag'], object_cache)
+            # Get the max values from the file in s3 according to fields_to_check_duplicates
+            max_values = get_max_values_from_csv(latest_s3_file_dataframe, fields_to_check_duplicates)
+    else:
+        latest_s3_file_dataframe = pl.concat([
+            Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name, entry['key'], fire_department_schema,
+                                                app_settings.s3_download_part_size,
+                                                app_settings.s3_download_concurrency, entry['etag'], object_cache)
+            for entry in get_history_entries(manifest)
+        ])
+        # Get the max values from the files in s3 according to fields_to_check_duplicates
+        max_values = get_max_values_from_csv(latest_s3_file_dataframe, fields_to_check_duplicates)
+
+    with tempfile.TemporaryDirectory() as output_directory:
+        # Generate mocked dataframes with new values, one per part file when the rows are sharded across processes
+        # Keys are allocated right above max_values so exactly num_new_rows unique rows are generated
+        if workers > 1:
+            part_file_names = generate_mocked_data_sharded(num_new_rows, max_values, seed, app_settings.shuffle_keys,
+                                                           workers, output_directory, end_datetime)
+            mocked_data_dataframes = [pl.read_parquet(part_file_name) for part_file_name in part_file_names]
+        else:
+            mocked_data_dataframes = [generate_mocked_data_as_dataframe(num_new_rows, max_values, seed,
+                                                                        app_settings.shuffle_keys, end_datetime)]
+
+    if not (mode == 'append' and multi_object):
+        mocked_data_dataframes = [pl.concat(mocked_data_dataframes)]
 
     # Validation layer
-    repeated_values = find_repeated_values_by_field(mocked_data_dataframe_cleaned, fields_to_check_duplicates)
-    if repeated_values.shape[0] > 0:
-        Utils.check_and_log_error(repeated_values)
+    mocked_data_dataframe = pl.concat(mocked_data_dataframes)
+    validate_unique_keys(mocked_data_dataframe, fields_to_check_duplicates)
+
+    if mode == 'append':
+        # Only the new rows are uploaded, as their own object(s)
+        new_latest_file_name = app_settings.delta_prefix + get_new_latest_file_name(latest_file_name,
+                                                                                    app_settings.file_format)
+        if len(mocked_data_dataframes) > 1:
+            output_objects = [(new_latest_file_name.replace('.', f'_part{part_number:05d}.', 1), dataframe)
+                              for part_number, dataframe in enumerate(mocked_data_dataframes)]
+        else:
+            output_objects = [(new_latest_file_name, mocked_data_dataframe)]
+    else:
+        # Append new DataFrame to the existing DataFrame
+        output_objects = [(get_new_latest_file_name(latest_file_name, app_settings.file_format),
+                           pl.concat([latest_s3_file_dataframe, mocked_data_dataframe]))]
+
+    check_new_keys(manifest, [new_latest_file_name for new_latest_file_name, _ in output_objects])
+    for new_latest_file_name, output_dataframe in output_objects:
+        # Send messages
+        etag, size = Utils.send_dataframe_to_s3(s3_client, bucket_name, new_latest_file_name, output_dataframe,
+                                                object_cache, fields_to_check_duplicates)
+        logger.info(f"Uploaded {len(output_dataframe)} rows in a {app_settings.file_format} file to S3 as "
+                    f"{new_latest_file_name}")
+
+        # Register the new object, the manifest is written last so readers never see an object that is not uploaded
+        manifest['objects'].append(get_manifest_entry(new_latest_file_name, etag, size, len(output_dataframe),
+                                                      'delta' if mode == 'append' else 'full'))
+    Utils.send_manifest_to_s3(s3_client, bucket_name, app_settings.manifest_file_name, manifest)
+
+    logger.info(f'New rows: {len(mocked_data_dataframe)}')
+    logger.info("Finished processing new mocked rows")
 
-    # Append new DataFrame to the existing DataFrame
-    combined_dataframe = pl.concat([latest_s3_file_dataframe, mocked_data_dataframe_cleaned])
 
-    # New latest_file_name
-    new_latest_file_name = get_new_latest_file_name(latest_file_name)
+def purge_retired_objects(app_settings: AppSettings, s3_client: boto3.client, manifest: dict) -> List[dict]:
+    # Objects replaced by a compaction stay on s3 for compaction_retention_seconds, a job that read the manifest
+    # before the compaction can still download them. Returns the entries whose retention is over, they are removed
+    # from the manifest and have to be deleted once it is written
+    retention_start = datetime.now() - timedelta(seconds=app_settings.compaction_retention_seconds)
+    retired_entries = manifest.get('retired', [])
+    expired_entries = [entry for entry in retired_entries
+                       if datetime.fromisoformat(entry['retired_at']) <= retention_start]
+    manifest['retired'] = [entry for entry in retired_entries if entry not in expired_entries]
+    return expired_entries
+
+
+def delete_retired_objects(s3_client: boto3.client, bucket_name: str, retired_entries: List[dict]) -> None:
+    for entry in retired_entries:
+        try:
+            # An object written again under the same key since it was retired is not the one to delete
+            if Utils.get_s3_object_etag(s3_client, bucket_name, entry['key']) != entry['etag']:
+                logger.warning(f"{entry['key']} changed since it was retired, it is not deleted")
+                continue
+        except s3_client.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                continue
+            raise
+        s3_client.delete_object(Bucket=bucket_name, Key=entry['key'])
+        logger.info(f"Deleted retired object {entry['key']}")
+
+
+def compact(app_settings: AppSettings, s3_client: boto3.client,
+            object_cache: Optional[S3ObjectCache] = None) -> None:
+    bucket_name = app_settings.bucket_name
+    manifest = Utils.read_manifest_from_s3(s3_client, bucket_name, app_settings.manifest_file_name)
+    if manifest is None:
+        logger.info('No manifest found on s3, nothing to compact')
+        return
+
+    # Consecutive run of small delta objects at the end of the history
+    small_entries = []
+    for entry in reversed(manifest['objects']):
+        if entry['kind'] not in ('delta', 'compacted') or entry['size'] >= app_settings.compaction_target_size:
+            break
+        small_entries.insert(0, entry)
+    expired_entries = purge_retired_objects(app_settings, s3_client, manifest)
+    if len(small_entries) < 2:
+        logger.info('Fewer than two small delta objects, nothing to compact')
+        if expired_entries:
+            Utils.send_manifest_to_s3(s3_client, bucket_name, app_settings.manifest_file_name, manifest)
+            delete_retired_objects(s3_client, bucket_name, expired_entries)
+        return
+
+    compacted_dataframe = pl.concat([
+        Utils.get_file_from_s3_as_dataframe(s3_client, bucket_name, entry['key'], fire_department_schema,
+                                            app_settings.s3_download_part_size, app_settings.s3_download_concurrency,
+                                            entry['etag'], object_cache)
+        for entry in small_entries
+    ])
+    compacted_file_name = app_settings.delta_prefix + get_new_latest_file_name(
+        small_entries[-1]['key'], app_settings.file_format).replace('.', '_compacted.', 1)
+    check_new_keys(manifest, [compacted_file_name])
+    etag, size = Utils.send_dataframe_to_s3(s3_client, bucket_name, compacted_file_name, compacted_dataframe,
+                                            object_cache, app_settings.fields_to_check_duplicates)
+
+    # The compacted object takes the place of the objects it replaces, readers that already ingested all of them
+    # can skip it
+    manifest['objects'] = manifest['objects'][:-len(small_entries)] + [
+        get_manifest_entry(compacted_file_name, etag, size, len(compacted_dataframe), 'compacted',
+                           replaces=small_entries)
+    ]
+    # Replaced objects are kept until a later compaction after their retention, jobs running now may still read them
+    retired_at = datetime.now().isoformat()
+    manifest['retired'] += [{'key': entry['key'], 'etag': entry['etag'], 'retired_at': retired_at}
+                            for entry in small_entries]
+    Utils.send_manifest_to_s3(s3_client, bucket_name, app_settings.manifest_file_name, manifest)
+
+    delete_retired_objects(s3_client, bucket_name, expired_entries)
+    logger.info(f'Compacted {len(small_entries)} delta objects ({len(compacted_dataframe)} rows) into '
+                f'{compacted_file_name}')
+
+
+def main(args=None) -> None:
+    arguments = parse_arguments(args)
 
-    # Send messages
-    Utils.send_csv_to_s3(s3_client, bucket_name, new_latest_file_name, combined_dataframe)
-    logger.info(f"Uploaded {len(combined_dataframe)} rows in a csv file to S3 as {new_latest_file_name}")
-    logger.info(f'New rows: {len(mocked_data_dataframe_cleaned)}')
-    logger.info("Finished processing new mocked rows")
+    app_settings = get_app_settings()
+    s3_client = boto3.client('s3', region_name=app_settings.region_name, endpoint_url=app_settings.local_stack_endpoint)
+    # Local copies of the objects, shared with the main job
+    object_cache = get_object_cache(app_settings)
+
+    if arguments.command == 'compact':
+        compact(app_settings, s3_client, object_cache)
+    else:
+        generate(app_settings, s3_client, arguments.mode or app_settings.output_mode, arguments.rows,
+                 arguments.seed, arguments.workers, arguments.multi_object, object_cache,
+                 get_end_datetime(arguments.end_date, arguments.seed, app_settings))
 
 
 if __name__ == "__main__":
@@ -4,7 +4,8 @@ CREATE EXTENSION IF NOT EXISTS postgis;
 -- Generic dim_date postgres table
 -- https://duffn.medium.com/creating-a-date-dimension-table-in-postgresql-af3f8e2941ac
 
-DROP TABLE if exists dim_date;
+-- Cascades to the foreign keys of the fact and its rollup when the script is run again
+DROP TABLE if exists dim_date CASCADE;
 
 CREATE TABLE dim_date
 (
@@ -95,23 +96,38 @@ drop table if exists public.dim_battalion;
 create table public.dim_battalion
 (
     dim_battalion_SK BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
-    battalion TEXT UNIQUE
+    battalion TEXT,
+    -- Hash of the member attributes, compared with the staged one to detect changes
+    row_hash bigint,
+    valid_from timestamp DEFAULT now(),
+    valid_to timestamp,
+    is_current boolean DEFAULT true
 );
 
+-- A natural key has a single current version, older versions are only kept by the type 2 merge
+create unique index dim_battalion_battalion_current_key on public.dim_battalion (battalion) where is_current;
+
 drop table if exists public.dim_district;
 create table public.dim_district
 (
     dim_district_SK BIGINT PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
-    neighborhood_district TEXT UNIQUE,
+    neighborhood_district TEXT,
     city text,
-    city_cleaned text
+    city_cleaned text,
+    row_hash bigint,
+    valid_from timestamp DEFAULT now(),
+    valid_to timestamp,
+    is_current boolean DEFAULT true
 );
 
+create unique index dim_district_neighborhood_district_current_key
+    on public.dim_district (neighborhood_district) where is_current;
+
 drop table if exists public.fact_fire_department_injuries;
 create table public.fact_fire_department_injuries
 (
     incident_number         bigint ,
-    id                      bigint PRIMARY KEY,
+    id                      bigint,
     incident_date           timestamp,
     dim_battalion_sk        bigint,
     dim_district_sk         bigint,
@@ -127,20 +143,54 @@ create table public.fact_fire_department_injuries
     fire_injuries           bigint,
     civilian_fatalities     bigint,
     civilian_injuries       bigint,
-    num_alarms              bigint
+    num_alarms              bigint,
+    -- Null when incident_date is null, any other key has to exist in dim_date
+    date_dim_id             int references public.dim_date (date_dim_id),
+    -- The partition key has to be part of the key, incident_date can be null so a unique constraint treating nulls
+    -- as equal is used instead of a primary key
+    constraint fact_fire_department_injuries_id_incident_date_key unique nulls not distinct (id, incident_date)
+) partition by range (incident_date);
+
+-- Monthly (or yearly) partitions are created by the job before every load, rows without incident_date land here
+create table public.fact_fire_department_injuries_default
+    partition of public.fact_fire_department_injuries default;
+
+-- Daily rollup of the fact at day x battalion x district grain, maintained by the job from the rows it inserts.
+-- Sums and counts are kept apart so averages stay exact when rolled up to any coarser grain
+drop table if exists public.agg_fire_department_injuries_daily;
+create table public.agg_fire_department_injuries_daily
+(
+    date_dim_id                 int references public.dim_date (date_dim_id),
+    dim_battalion_sk            bigint,
+    dim_district_sk             bigint,
+    incident_count              bigint,
+    num_alarms_sum              bigint,
+    num_alarms_count            bigint,
+    estimated_property_loss_sum double precision,
+    personnel_response_sum      bigint,
+    personnel_response_count    bigint,
+    fire_fatalities_sum         bigint,
+    civilian_fatalities_sum     bigint,
+    constraint agg_fire_department_injuries_daily_pk primary key (date_dim_id, dim_battalion_sk, dim_district_sk)
 );
 
+-- Bronze rows keep the S3 object they were read from, a run reloading an object deletes the rows an earlier failed
+-- run committed for it first, so a retry never appends the same rows twice
 drop table if exists public.raw_dim_district;
 create table public.raw_dim_district
 (
     neighborhood_district text,
-    city                  text
+    city                  text,
+    object_key            text,
+    object_etag           text
 );
 
 drop table if exists public.raw_dim_battalion;
 create table public.raw_dim_battalion
 (
-    battalion text
+    battalion   text,
+    object_key  text,
+    object_etag text
 );
 
 drop table if exists public.raw_fact_fire_department;
@@ -209,13 +259,19 @@ create table public.raw_fact_fire_department
     num_sprinkler_heads_operating                 double precision,
     supervisor_district                           double precision,
     neighborhood_district                         text,
-    point                                         text
+    point                                         text,
+    object_key                                    text,
+    object_etag                                   text
 );
 
+create index raw_fact_fire_department_object_idx on public.raw_fact_fire_department (object_key, object_etag);
+
 drop table if exists public.stg_dim_battalion;
 create table public.stg_dim_battalion
 (
-    battalion text
+    battalion text,
+    batch_id  bigint,
+    row_hash  bigint
 );
 
 drop table if exists public.stg_dim_district;
@@ -223,7 +279,9 @@ create table public.stg_dim_district
 (
     neighborhood_district text,
     city                  text,
-    city_cleaned          text
+    city_cleaned          text,
+    batch_id              bigint,
+    row_hash              bigint
 );
 
 drop table if exists public.stg_fact_fire_department_injuries;
@@ -246,6 +304,61 @@ create table public.stg_fact_fire_department_injuries
     fire_injuries           bigint,
     civilian_fatalities     bigint,
     civilian_injuries       bigint,
-    num_alarms              bigint
+    num_alarms              bigint,
+    batch_id                bigint,
+    dim_battalion_sk        bigint,
+    dim_district_sk         bigint
 );
 
+
+drop table if exists public.etl_ingestion_manifest;
+create table public.etl_ingestion_manifest
+(
+    object_key          text,
+    etag                text,
+    max_id              bigint,
+    max_incident_number bigint,
+    rows_loaded         bigint,
+    loaded_at           timestamp default now(),
+    -- warehouse when the object went through silver and gold, bronze when its raw copy was loaded
+    stage               text not null default 'warehouse',
+    PRIMARY KEY (object_key, etag, stage)
+);
+
+drop sequence if exists public.etl_batch_id_seq;
+create sequence public.etl_batch_id_seq;
+
+drop table if exists public.pipeline_run_metrics;
+create table public.pipeline_run_metrics
+(
+    run_id       text,
+    stage        text,
+    started_at   timestamp,
+    wall_seconds double precision,
+    cpu_seconds  double precision,
+    rows         bigint,
+    bytes        bigint,
+    -- Highest resident set size of the job process sampled while the stage ran, and how far it rose over the size the
+    -- stage started with. Stages running at the same time see each other's memory
+    peak_rss_mb  double precision,
+    rss_delta_mb double precision,
+    status       text,
+    attributes   jsonb,
+    recorded_at  timestamp default now()
+);
+
+drop table if exists public.dq_quarantine;
+create table public.dq_quarantine
+(
+    -- Null for rows quarantined by a bronze-only run
+    batch_id        bigint,
+    stage           text,
+    object_key      text,
+    object_etag     text,
+    id              bigint,
+    incident_number bigint,
+    -- ';' separated <column>:<rule> codes of every rule the row failed
+    reason_codes    text,
+    record          jsonb,
+    quarantined_at  timestamp
+);